@@ -0,0 +1,389 @@
+"""
+In-process stand-ins for the services config.py connects to.
+
+They sit under the real clients: FakePsycopgConnection replaces psycopg2.connect,
+FakeSphinxConnection replaces pymysql.connect, FakeGridFS replaces MongoC.fs and
+FakeSession replaces CropperDaemon.session. PsgClient, SphinxSearch, MongoC,
+CropperDaemon and their pools and caches run unchanged on top of them. Every
+round trip sleeps for the configured latency and is counted by BackendCalls.
+"""
+import collections
+import datetime
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+
+import pymysql
+
+
+class BackendCalls(object):
+    """
+    Round trips per backend, for the whole run and for the request running in the current thread
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.totals = collections.Counter()
+        self.background = collections.Counter()
+
+    def start_request(self):
+        self._local.calls = collections.Counter()
+
+    def end_request(self):
+        calls = getattr(self._local, 'calls', None)
+        self._local.calls = None
+        return calls or collections.Counter()
+
+    def hit(self, backend):
+        with self._lock:
+            self.totals[backend] += 1
+        calls = getattr(self._local, 'calls', None)
+        if calls is not None:
+            calls[backend] += 1
+        else:
+            # history flushes, pool pings and other work outside of a request thread
+            with self._lock:
+                self.background[backend] += 1
+
+
+class Dataset(object):
+    """
+    Random but reproducible catalogue: songs, albums, transcription rows, likes and history
+    """
+
+    def __init__(self, songs=500, albums=100, rows_per_song=40, users=50, likes_per_user=30,
+                 cover_size=30 * 1024, sphinx_hits=20, seed=42):
+        rnd = random.Random(seed)
+        self.rnd = rnd
+        self.sphinx_hits = sphinx_hits
+        self.words = ['word{}'.format(i) for i in range(2000)]
+
+        self.albums = {}
+        self.covers = {}
+        for album_id in range(1, albums + 1):
+            cover_id = '%024x' % rnd.getrandbits(96)
+            self.albums[album_id] = (self._title(), cover_id, rnd.randint(1960, 2017))
+            self.covers[cover_id] = bytes(bytearray(rnd.getrandbits(8) for _ in range(64))) * (cover_size // 64)
+
+        self.songs = {}
+        self.transcription = collections.OrderedDict()
+        transcription_id = 1
+        for song_id in range(1, songs + 1):
+            lines = []
+            start = 0
+            for _ in range(rows_per_song):
+                length = rnd.choice([1500, 3000, 4500, 7000, 12000])
+                phrase = ' '.join(rnd.choice(self.words) for _ in range(rnd.randint(4, 18))).capitalize()
+                self.transcription[transcription_id] = (song_id, start, start + length, phrase)
+                lines.append(phrase)
+                transcription_id += 1
+                start += length
+            self.songs[song_id] = (
+                'Author {}'.format(rnd.randint(1, songs // 3 + 1)), self._title(), '\n'.join(lines),
+                '%024x' % rnd.getrandbits(96), rnd.randint(1, albums), 'https://youtu.be/{}'.format(song_id), song_id * 7)
+        self.transcription_ids = list(self.transcription)
+
+        self.tokens = {'token{}'.format(user_id): user_id for user_id in range(1, users + 1)}
+        now = datetime.datetime(2017, 6, 1)
+        self.likes = {}
+        for user_id in range(1, users + 1):
+            liked = rnd.sample(sorted(self.songs), min(likes_per_user, songs))
+            self.likes[user_id] = {
+                song_id: now - datetime.timedelta(minutes=rnd.randint(0, 100000))
+                for song_id in liked
+            }
+
+        self.query_history = collections.Counter()
+        self.song_history = collections.Counter()
+        for _ in range(songs * 10):
+            self.query_history[' '.join(rnd.sample(self.words[:300], 2))] += 1
+            self.song_history[rnd.randint(1, songs)] += 1
+
+    def _title(self):
+        return ' '.join(self.rnd.choice(['Love', 'Night', 'Road', 'Fire', 'Heart', 'Rain', 'Home', 'Gold'])
+                        for _ in range(self.rnd.randint(1, 3)))
+
+    def sphinx_match(self, phrase):
+        digest = int(hashlib.md5(phrase.encode('utf-8')).hexdigest(), 16)
+        if digest % 10 == 0:
+            return []
+        rnd = random.Random(digest)
+        return rnd.sample(self.transcription_ids, min(self.sphinx_hits, len(self.transcription_ids)))
+
+
+class FakePsycopgConnection(object):
+    """
+    Enough of a psycopg2 connection for PsgClient: answers its queries from a Dataset
+    """
+    encoding = 'UTF8'
+
+    def __init__(self, dataset, calls, latency):
+        self.dataset = dataset
+        self.calls = calls
+        self.latency = latency
+        self.closed = 0
+
+    def cursor(self):
+        return FakePsycopgCursor(self)
+
+    def get_transaction_status(self):
+        return 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePsycopgCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = False
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def mogrify(self, template, args):
+        return repr(tuple(args)).encode('utf-8')
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def execute(self, sql, params=None):
+        self.connection.calls.hit('postgres')
+        time.sleep(self.connection.latency)
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8')
+        self.rows = self._answer(' '.join(sql.split()), params or ())
+
+    def _answer(self, sql, params):
+        data = self.connection.dataset
+        if sql.startswith('SELECT 1') or sql.startswith('INSERT INTO'):
+            return []
+        if 'array_agg(t.start_time_ms)' in sql:
+            by_song = collections.OrderedDict()
+            for transcription_id in params[0]:
+                row = data.transcription.get(transcription_id)
+                if row is None:
+                    continue
+                song = data.songs[row[0]]
+                entry = by_song.setdefault(row[0], (row[0], song[4], song[3], [], [], []))
+                entry[3].append(row[1])
+                entry[4].append(row[2])
+                entry[5].append(transcription_id)
+            return list(by_song.values())
+        if sql.startswith('SELECT t.id, t.songid, t.phrase'):
+            return [(i,) + (data.transcription[i][0], data.transcription[i][3])
+                    for i in params[0] if i in data.transcription]
+        if sql.startswith('SELECT t.id, t.songid FROM'):
+            return [(i, data.transcription[i][0]) for i in params[0] if i in data.transcription]
+        if sql.startswith('SELECT DISTINCT t.songid FROM transcription AS t WHERE t.id=ANY'):
+            return sorted({(data.transcription[i][0],) for i in params[0] if i in data.transcription})
+        if sql.startswith('SELECT t.phrase FROM transcription'):
+            song_id, ids = params
+            return [(data.transcription[i][3],) for i in sorted(ids)
+                    if i in data.transcription and data.transcription[i][0] == song_id]
+        if sql.startswith('SELECT s.id, s.author'):
+            return [(i,) + data.songs[i] for i in params[0] if i in data.songs]
+        if sql.startswith('SELECT s.author'):
+            song = data.songs.get(int(params[0]))
+            return [song] if song else []
+        if sql.startswith('SELECT id, title, cover_id, year FROM album'):
+            return [(i,) + data.albums[i] for i in params[0] if i in data.albums]
+        if sql.startswith('SELECT title, cover_id, year FROM album'):
+            album = data.albums.get(params[0])
+            return [album] if album else []
+        if sql.startswith('SELECT DISTINCT sl.song_id FROM song_likes'):
+            song_ids, user_id = params
+            return [(i,) for i in song_ids if i in data.likes.get(user_id, {})]
+        if sql.startswith('SELECT sl.song_id FROM song_likes'):
+            song_id, user_id = params
+            return [(song_id,)] if song_id in data.likes.get(user_id, {}) else []
+        if sql.startswith('SELECT u.id FROM users'):
+            user_id = data.tokens.get(params[0])
+            return [(user_id,)] if user_id else []
+        if sql.startswith('SELECT qh.query, COUNT(*)'):
+            return [row for row in data.query_history.most_common() if len(row[0]) > 4][:self._limit(sql)]
+        if sql.startswith('SELECT sh.songid, COUNT(*)'):
+            return data.song_history.most_common(self._limit(sql))
+        if sql.startswith('SELECT s.id, SUBSTR(s.title, 2)'):
+            rows = sorted(((i, song[1][1:]) for i, song in data.songs.items()), key=lambda row: (row[1], row[0]))
+            if params:
+                rows = [row for row in rows if (row[1], row[0]) > tuple(params)]
+            return self._page(sql, rows)
+        if sql.startswith('SELECT sl.song_id, sl.created_at FROM song_likes'):
+            likes = data.likes.get(params[0], {})
+            rows = sorted(likes.items(), key=lambda row: (row[1], row[0]), reverse=True)
+            if len(params) > 1:
+                after = (datetime.datetime.strptime(params[1][:19], '%Y-%m-%dT%H:%M:%S'), params[2])
+                rows = [row for row in rows if (row[1], row[0]) < after]
+            return self._page(sql, rows)
+        raise ValueError('fake postgres does not know this query: {}'.format(sql))
+
+    @staticmethod
+    def _limit(sql):
+        return int(re.search(r'LIMIT (\d+)', sql).group(1))
+
+    def _page(self, sql, rows):
+        offset = re.search(r'OFFSET (\d+)', sql)
+        offset = int(offset.group(1)) if offset else 0
+        return rows[offset:offset + self._limit(sql)]
+
+
+class FakeSphinxConnection(object):
+    """
+    Enough of a pymysql connection for SphinxSearch, MATCH results come from Dataset.sphinx_match
+    """
+
+    def __init__(self, dataset, calls, latency):
+        self.dataset = dataset
+        self.calls = calls
+        self.latency = latency
+        self.open = True
+
+    def escape(self, value):
+        return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+    def cursor(self):
+        return FakeSphinxCursor(self)
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+class FakeSphinxCursor(object):
+    """
+    Reads a multi-statement batch one result at a time like pymysql: a failing statement raises
+    from execute() or nextset(), and closing the cursor drains whatever is left on the socket.
+    A phrase with a double quote in it fails like a Sphinx syntax error.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.pending = []
+        self.has_next = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        while self.nextset():
+            pass
+
+    def execute(self, sql, params=None):
+        self.connection.calls.hit('sphinx')
+        time.sleep(self.connection.latency)
+        self.pending = [
+            literal.replace("\\'", "'").replace('\\\\', '\\')
+            for literal in re.findall(r"match\('((?:[^'\\]|\\.)*)'\);", sql)
+        ]
+        self._advance()
+
+    def _advance(self):
+        match = self.pending.pop(0)
+        phrase = match[1:match.rindex('"/')]
+        if '"' in phrase:
+            # pymysql keeps the has_next flag of the previous result, closing then reads the socket again
+            self.pending = []
+            raise pymysql.err.ProgrammingError(1064, 'sphinxql: syntax error near \'{}\''.format(phrase))
+        self.rows = [(i,) for i in self.connection.dataset.sphinx_match(phrase)]
+        self.has_next = bool(self.pending)
+
+    def fetchall(self):
+        return self.rows
+
+    def nextset(self):
+        if not self.has_next:
+            return None
+        if not self.connection.open:
+            raise AttributeError("'NoneType' object has no attribute 'settimeout'")
+        if not self.pending:
+            # the failed statement ended the batch
+            self.has_next = False
+            return None
+        self._advance()
+        return True
+
+
+class FakeGridOut(io.BytesIO):
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.length = len(data)
+
+
+class FakeGridFS(object):
+    def __init__(self, dataset, calls, latency):
+        self.dataset = dataset
+        self.calls = calls
+        self.latency = latency
+
+    def find_one(self, query):
+        self.calls.hit('mongo')
+        time.sleep(self.latency)
+        data = self.dataset.covers.get(str(query['_id']))
+        return FakeGridOut(data) if data is not None else None
+
+    def exists(self, object_id):
+        self.calls.hit('mongo')
+        time.sleep(self.latency)
+        return str(object_id) in self.dataset.covers
+
+
+class FakeResponse(object):
+    ok = True
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Cropper daemon: answers with ~16 KiB of mp3 per second of requested audio
+    """
+
+    def __init__(self, calls, latency):
+        self.calls = calls
+        self.latency = latency
+
+    def post(self, url, data=None, timeout=None, stream=False):
+        self.calls.hit('cropper')
+        time.sleep(self.latency)
+        intervals = json.loads(data)['intervals']
+        seconds = sum(max(0, end - start) for start, end in intervals) / 1000.0
+        return FakeResponse(b'\xff\xfb' * int(seconds * 8 * 1024))
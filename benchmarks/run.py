@@ -0,0 +1,200 @@
+"""
+Offline load benchmark of cherry_pick_api.
+
+Boots the real app and config against the stand-ins from benchmarks/fakes.py
+(no network, no Sphinx/Postgres/Mongo/cropper needed) and drives a request mix
+over /api/v2/search, /song/popular, /song/all, /cover and /song/<id>/stream.
+Reports throughput, p50/p99 latency and backend round trips per request.
+
+Usage: python benchmarks/run.py [--requests 2000] [--concurrency 4] [--latency-ms 1] ...
+"""
+import argparse
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fakes  # noqa: E402
+
+BACKENDS = ('postgres', 'sphinx', 'mongo', 'cropper')
+MIX = (
+    ('search', 50),
+    ('song_popular', 15),
+    ('song_all', 10),
+    ('cover', 15),
+    ('stream', 10),
+)
+
+
+def boot(dataset, calls, args):
+    """
+    Import config and cherry_pick_api with the service drivers swapped for fakes
+    """
+    import psycopg2
+    import pymysql
+
+    def latency(backend):
+        value = getattr(args, backend + '_latency_ms')
+        return (value if value is not None else args.latency_ms) / 1000.0
+
+    for name in ('SPHINX_HOST', 'PSQL_HOST', 'PSQL_USER', 'PSQL_PASSWORD', 'CROPPER_HOST', 'MONGO_HOST'):
+        os.environ[name] = 'bench'
+    os.environ.pop('MEMCACHED_HOST', None)
+    psycopg2.connect = lambda *a, **k: fakes.FakePsycopgConnection(dataset, calls, latency('postgres'))
+    pymysql.connect = lambda *a, **k: fakes.FakeSphinxConnection(dataset, calls, latency('sphinx'))
+
+    import config
+    config.logger.setLevel(logging.WARNING)
+    config.mongo.fs = fakes.FakeGridFS(dataset, calls, latency('mongo'))
+    config.cropper.session = fakes.FakeSession(calls, latency('cropper'))
+
+    import cherry_pick_api
+    cherry_pick_api.limiter.enabled = False
+    cherry_pick_api.app.logger.disabled = True
+    return cherry_pick_api.app
+
+
+class Workload(object):
+    def __init__(self, dataset, seed, search_queries=300, clips=200):
+        self.rnd = random.Random(seed)
+        self.dataset = dataset
+        phrases = [row[3].lower().split() for row in dataset.transcription.values()]
+        self.queries = []
+        for _ in range(search_queries):
+            words = self.rnd.choice(phrases)
+            start = self.rnd.randrange(max(1, len(words) - 3))
+            self.queries.append(' '.join(words[start:start + self.rnd.randint(2, 4)]))
+        self.covers = [album[1] for album in dataset.albums.values()]
+        self.clips = []
+        for _ in range(clips):
+            song_id, start, end, _ = self.rnd.choice(list(dataset.transcription.values()))
+            self.clips.append((song_id, max(0, start - 4000), end + 4000))
+        self.tokens = list(dataset.tokens)
+        self.names = [name for name, _ in MIX]
+        self.weights = [weight for _, weight in MIX]
+
+    def _popular(self, items):
+        # a few hot items and a long tail
+        index = min(len(items) - 1, int(self.rnd.paretovariate(1.2)) - 1)
+        return items[index]
+
+    def _token(self):
+        if self.rnd.random() < 0.3:
+            return '&api_token=' + self.rnd.choice(self.tokens)
+        return ''
+
+    def next(self):
+        name = self.rnd.choices(self.names, self.weights)[0] if hasattr(self.rnd, 'choices') \
+            else self._weighted_choice()
+        if name == 'search':
+            return name, '/api/v2/search?query={}{}'.format(self._popular(self.queries), self._token())
+        if name == 'song_popular':
+            return name, '/api/v2/song/popular?limit=10' + self._token()
+        if name == 'song_all':
+            return name, '/api/v2/song/all?limit=20&page={}{}'.format(self.rnd.randint(1, 10), self._token())
+        if name == 'cover':
+            return name, '/api/v2/cover?path=' + self._popular(self.covers)
+        song_id, start, end = self._popular(self.clips)
+        return name, '/api/v2/song/{}/stream/{}/{}'.format(song_id, start, end)
+
+    def _weighted_choice(self):
+        point = self.rnd.uniform(0, sum(self.weights))
+        for name, weight in zip(self.names, self.weights):
+            point -= weight
+            if point <= 0:
+                return name
+        return self.names[-1]
+
+
+def drive(app, calls, requests, concurrency):
+    results = []
+    lock = threading.Lock()
+    pending = collections.deque(requests)
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                name, url = pending.popleft()
+            calls.start_request()
+            started = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            used = calls.end_request()
+            with lock:
+                results.append((name, elapsed, used, response.status_code))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(results, wall_time, calls):
+    print('{} requests in {:.2f}s, {:.1f} req/s'.format(len(results), wall_time, len(results) / wall_time))
+    header = '{:<14}{:>7}{:>10}{:>10}{:>10}' + '{:>10}' * len(BACKENDS)
+    row = '{:<14}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}' + '{:>10.2f}' * len(BACKENDS)
+    print(header.format('endpoint', 'count', 'mean ms', 'p50 ms', 'p99 ms', *BACKENDS))
+    by_name = collections.OrderedDict((name, []) for name, _ in MIX)
+    for result in results:
+        by_name[result[0]].append(result)
+    by_name['all'] = results
+    for name, rows in by_name.items():
+        if not rows:
+            continue
+        latencies = [r[1] * 1000 for r in rows]
+        per_request = [sum(r[2][backend] for r in rows) / float(len(rows)) for backend in BACKENDS]
+        print(row.format(
+            name, len(rows), sum(latencies) / len(latencies),
+            percentile(latencies, 0.5), percentile(latencies, 0.99), *per_request))
+    statuses = collections.Counter(r[3] for r in results)
+    print('status codes: {}'.format(dict(statuses)))
+    print('background round trips (history flushes, pool checks): {}'.format(dict(calls.background)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200, help='requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='round trip latency of every backend')
+    for backend in BACKENDS:
+        parser.add_argument('--{}-latency-ms'.format(backend), type=float, default=None)
+    parser.add_argument('--songs', type=int, default=500)
+    parser.add_argument('--albums', type=int, default=100)
+    parser.add_argument('--rows-per-song', type=int, default=40)
+    parser.add_argument('--sphinx-hits', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    dataset = fakes.Dataset(
+        songs=args.songs, albums=args.albums, rows_per_song=args.rows_per_song,
+        sphinx_hits=args.sphinx_hits, seed=args.seed)
+    calls = fakes.BackendCalls()
+    app = boot(dataset, calls, args)
+
+    workload = Workload(dataset, args.seed)
+    drive(app, calls, [workload.next() for _ in range(args.warmup)], args.concurrency)
+    calls.background.clear()
+    results, wall_time = drive(app, calls, [workload.next() for _ in range(args.requests)], args.concurrency)
+    report(results, wall_time, calls)
+
+
+if __name__ == '__main__':
+    main()
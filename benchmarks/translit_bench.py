@@ -0,0 +1,104 @@
+"""
+Per-query latency of the /api/v2/search transliteration pass.
+
+Compares the old per-word difflib scan over translit_dict with TranslitIndex,
+cold (fresh index, empty LRU) and warm (every word already resolved), and
+checks that both give the same matches.
+
+Usage: python benchmarks/translit_bench.py [queries]
+"""
+import difflib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from external.mazafaka import translit_dict  # noqa: E402
+from external.translit import TranslitIndex  # noqa: E402
+
+
+def make_queries(count, seed=42):
+    rnd = random.Random(seed)
+    keys = list(translit_dict.keys())
+    alphabet = u'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    queries = []
+    for _ in range(count):
+        words = []
+        for _ in range(rnd.randint(2, 6)):
+            word = rnd.choice(keys)
+            roll = rnd.random()
+            if roll < 0.3 and len(word) > 2:
+                # typo: replace one letter
+                pos = rnd.randrange(len(word))
+                word = word[:pos] + rnd.choice(alphabet) + word[pos + 1:]
+            elif roll < 0.4:
+                word = u''.join(rnd.choice(alphabet) for _ in range(rnd.randint(3, 9)))
+            words.append(word)
+        queries.append(u' '.join(words))
+    return queries
+
+
+def translit_difflib(query):
+    updated_q = []
+    for word in query.split(' '):
+        closest_word = difflib.get_close_matches(word, translit_dict.keys(), n=1, cutoff=0.7)
+        if len(closest_word) > 0:
+            updated_q.append(translit_dict.get(closest_word[0]))
+    return updated_q
+
+
+def translit_index(index, query):
+    updated_q = []
+    for word in query.split(' '):
+        translated = index.translate(word)
+        if translated is not None:
+            updated_q.append(translated)
+    return updated_q
+
+
+def measure(func, queries):
+    timings = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(func(query))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return results, timings
+
+
+def report(name, timings):
+    mean = sum(timings) / len(timings)
+    p50 = timings[len(timings) // 2]
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print('{:<22} mean {:>9.3f} ms   p50 {:>9.3f} ms   p99 {:>9.3f} ms'.format(
+        name, mean * 1000, p50 * 1000, p99 * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    queries = make_queries(count)
+    print('{} keys, {} queries'.format(len(translit_dict), len(queries)))
+
+    started = time.perf_counter()
+    index = TranslitIndex(translit_dict)
+    print('index build: {:.1f} ms'.format((time.perf_counter() - started) * 1000))
+
+    expected, difflib_timings = measure(translit_difflib, queries)
+    cold, cold_timings = measure(lambda q: translit_index(index, q), queries)
+    warm, warm_timings = measure(lambda q: translit_index(index, q), queries)
+
+    report('difflib scan', difflib_timings)
+    report('index (cold cache)', cold_timings)
+    report('index (warm cache)', warm_timings)
+
+    if expected != cold or expected != warm:
+        print('MISMATCH between difflib and index results')
+        sys.exit(1)
+    print('results identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Fill transcription_snippets with the padded time window and display lines of every
+transcription row, so /api/v2/search does not split lyrics per request.
+
+Usage:
+    python build_snippets.py              # songs with rows missing from the store (newly ingested)
+    python build_snippets.py --all        # rebuild every song
+    python build_snippets.py 12 13        # rebuild the given songs
+
+Then run the api with USE_SNIPPET_STORE=true. Needs PSQL_HOST, PSQL_USER and PSQL_PASSWORD,
+and the table from sql/snippets.sql.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from external.pg_client import PsgClient
+
+logger = logging.getLogger('cherry-pick-snippets')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute lyric snippets for search results')
+    parser.add_argument('song_ids', nargs='*', type=int, help='songs to rebuild')
+    parser.add_argument('--all', action='store_true', help='rebuild every song')
+    args = parser.parse_args()
+
+    postgres = PsgClient(
+        logger, os.environ['PSQL_HOST'], os.environ['PSQL_USER'], os.environ['PSQL_PASSWORD'], 'track_bar')
+
+    song_ids = args.song_ids or postgres.get_snippet_song_ids(missing_only=not args.all)
+    logger.info('Building snippets for {} songs'.format(len(song_ids)))
+    rows = 0
+    failed = 0
+    for i, song_id in enumerate(song_ids):
+        written = postgres.build_song_snippets(song_id)
+        if written == tuple():
+            failed += 1
+        else:
+            rows += written
+        if (i + 1) % 100 == 0:
+            logger.info('{}/{} songs, {} rows'.format(i + 1, len(song_ids), rows))
+    logger.info('Done: {} rows for {} songs, {} songs failed'.format(rows, len(song_ids) - failed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
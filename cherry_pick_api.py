@@ -1,39 +1,110 @@
 # coding=utf-8
-import difflib
-import io
-import os
-import tempfile
+import base64
+import gzip
 import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from distutils.util import strtobool
 
+import requests
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 from flask import Flask
 from flask import Response
-from flask import after_this_request, jsonify, request, send_file
+from flask import g, has_app_context, jsonify, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
-from config import mongo, sphinx, postgres, cropper
+from config import mongo, sphinx, postgres, cropper, history, popular_queries, popular_songs, search_cache, \
+    token_cache, metrics
 from external import utils
 from external.mazafaka import translit_dict
+from external.translit import TranslitIndex
 
 UPLOAD_FOLDER = '/tmp/uploads'
 NOT_FLAC_EXTENSIONS = {'mp3', 'aac', 'm4a', 'ogg'}
 FLAC_EXTENSIONS = {'wav', 'flac'}
 ALLOWED_EXTENSIONS = NOT_FLAC_EXTENSIONS | FLAC_EXTENSIONS
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+AUDIO_TIMEOUT = 30
+_NOT_RESOLVED = object()
 
 app = Flask(__name__)
 app.debug = True
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 1 * 1024 * 1024
+app.config['JSON_RESPONSE_PRETTY'] = bool(strtobool(os.environ.get('JSON_PRETTY', 'false')))
+app.config['JSON_COMPRESS_MIN_SIZE'] = int(os.environ.get('JSON_COMPRESS_MIN_SIZE', 1024))
+app.config['JSON_COMPRESS_LEVEL'] = int(os.environ.get('JSON_COMPRESS_LEVEL', 5))
+app.config['SERVER_TIMING'] = bool(strtobool(os.environ.get('SERVER_TIMING', 'true')))
 limiter = Limiter(
     app,
     key_func=get_remote_address,
     default_limits=['60 per minute'],
 )
+translit_index = TranslitIndex(translit_dict, cutoff=0.7)
+# ffmpeg and speech recognition run here, so a burst of uploads can not fork unbounded processes
+audio_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('AUDIO_WORKERS', 2)))
+# the executor queue is unbounded, past this many queued or running jobs uploads are turned away
+audio_slots = threading.BoundedSemaphore(int(os.environ.get('AUDIO_MAX_PENDING', 8)))
+lookup_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('LOOKUP_WORKERS', 4)))
+
+
+def json_dumps(obj_or_array):
+    if app.config['JSON_RESPONSE_PRETTY']:
+        return json.dumps(obj_or_array, sort_keys=True, indent=4)
+    if ujson is not None:
+        return ujson.dumps(obj_or_array, escape_forward_slashes=False)
+    return json.dumps(obj_or_array, separators=(',', ':'))
 
 
 def json_response(obj_or_array):
-    return Response(json.dumps(obj_or_array, sort_keys=True, indent=4), mimetype='application/json')
+    body = json_dumps(obj_or_array).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if len(body) < app.config['JSON_COMPRESS_MIN_SIZE']:
+        return response
+
+    encodings = request.accept_encodings
+    if encodings['gzip']:
+        response.set_data(gzip.compress(body, app.config['JSON_COMPRESS_LEVEL']))
+        response.content_encoding = 'gzip'
+    elif encodings['deflate']:
+        response.set_data(zlib.compress(body, app.config['JSON_COMPRESS_LEVEL']))
+        response.content_encoding = 'deflate'
+    return response
+
+
+def project_songs(songs):
+    """
+    Opt-in field projection of song dicts:
+    ?fields=id,title,lyrics_chunks keeps only the listed keys,
+    ?include_lyrics=false drops the full `lyrics` text
+    """
+    fields = get_arg('fields')
+    try:
+        include_lyrics = strtobool(get_arg('include_lyrics', 'true'))
+    except ValueError:
+        include_lyrics = True
+    if not fields and include_lyrics:
+        return songs
+
+    wanted = {field.strip() for field in fields.split(',') if field.strip()} if fields else None
+    return [
+        {
+            key: value
+            for key, value in song.items()
+            if (wanted is None or key in wanted) and (include_lyrics or key != 'lyrics')
+        }
+        for song in songs
+    ]
 
 
 def get_arg(key, default=None):
@@ -43,8 +114,17 @@ def get_arg(key, default=None):
         return request.args.get(key, default)
 
 
-# TODO: cache me
 def get_user():
+    """
+    User of the current request, resolved once per request and shared across requests through token_cache
+    """
+    user = getattr(g, '_user', _NOT_RESOLVED)
+    if user is _NOT_RESOLVED:
+        user = g._user = _resolve_user()
+    return user
+
+
+def _resolve_user():
     api_token = request.args.get('api_token')
 
     if api_token is None or not len(api_token):
@@ -53,7 +133,55 @@ def get_user():
     if api_token is None or not len(api_token):
         return None
 
-    return postgres.get_user_by_token(api_token)
+    user = token_cache.get(api_token)
+    if user is None:
+        # unknown tokens are not cached, a token issued a second ago must work right away
+        user = postgres.get_user_by_token(api_token) or None
+        if user is not None:
+            token_cache.set(api_token, user)
+    return user
+
+
+def invalidate_token(api_token=None):
+    """
+    Forget a revoked token, or every cached token when api_token is None.
+    Other workers drop it when the cached entry expires (TOKEN_CACHE_TTL).
+    """
+    if api_token is None:
+        token_cache.clear()
+    else:
+        token_cache.delete(api_token)
+    if has_app_context():
+        g.pop('_user', None)
+
+
+@app.before_request
+def start_timing():
+    g._started = time.time()
+    metrics.start_request()
+
+
+@app.after_request
+def finish_timing(response):
+    started = g.get('_started')
+    duration = time.time() - started if started is not None else None
+    endpoint = request.endpoint or 'unmatched'
+    timings = metrics.detach_request()
+    if response.is_streamed and started is not None:
+        # covers and songs are sent after this hook, record the request once the body is out
+        response.response = metrics.end_request_after(
+            response.response, endpoint, response.status_code, started, timings)
+    else:
+        metrics.end_request(endpoint, response.status_code, duration, timings)
+    if timings is not None and app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = timings.server_timing(duration, streamed=response.is_streamed)
+    return response
+
+
+@app.route('/metrics')
+@limiter.exempt
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/')
@@ -96,82 +224,197 @@ def voice_search():
             'code': '400',
             'message': 'wrong format for audio file expected {} got {}'.format(NOT_FLAC_EXTENSIONS, file.filename)
         })
-    source_file_path = tempfile.NamedTemporaryFile(delete=False, suffix='-user-uploaded').name
-    file.save(source_file_path)
-    result_file_path = tempfile.NamedTemporaryFile(delete=False, suffix='.wav').name
-    if file_extension in NOT_FLAC_EXTENSIONS:
-        if not utils.convert_to_wav(app.logger, source_file_path, result_file_path):
-            return jsonify({
-                'code': '500',
-                'message': 'failed to encode from {} to .wav format'.format(file_extension)
-            })
-    else:
-        result_file_path = source_file_path
-    result = utils.retrieve_phrase(app.logger, result_file_path)
+    audio_data = file.read()
+    if not audio_slots.acquire(False):
+        return jsonify({
+            'code': '503',
+            'message': 'too many voice searches in progress, try again later'
+        })
+    try:
+        future = audio_pool.submit(recognize_upload, audio_data, file_extension)
+    except Exception:
+        audio_slots.release()
+        raise
+    future.add_done_callback(lambda _: audio_slots.release())
+    try:
+        with metrics.timer('speech', 'recognize'):
+            result = future.result(timeout=AUDIO_TIMEOUT)
+    except FutureTimeoutError:
+        # drop it if it is still queued, a running job is bounded by the ffmpeg and recognizer timeouts
+        future.cancel()
+        app.logger.error('Voice search timed out after {} seconds'.format(AUDIO_TIMEOUT))
+        return jsonify({
+            'code': '504',
+            'message': 'audio recognition timed out'
+        })
+    except Exception as e:
+        app.logger.error(e)
+        result = None
+    if result is None:
+        return jsonify({
+            'code': '500',
+            'message': 'failed to encode from {} to .wav format'.format(file_extension)
+        })
 
+    user = get_user()
     final_array = []
-    for phrase in result:
-        found_chunk_ids = sphinx.find_songs(phrase, percent='1.0')
-        song_ids = postgres.get_found_songs_number(found_chunk_ids)
+    found_chunk_ids = sphinx.find_songs_batch(result, percent='1.0')
+    for phrase, song_ids in zip(result, lookup_pool.map(
+            metrics.propagate(postgres.get_found_songs_number), found_chunk_ids)):
         final_array.append({
             'query': phrase,
             'songs': len(song_ids),
-            'full_info': [song_full_pack_info({'id': id}) for id in song_ids]
+            'full_info': project_songs(songs_full_pack_info([{'id': id} for id in song_ids], user=user))
         })
 
-    @after_this_request
-    def remove_file(response):
-        try:
-            os.remove(source_file_path)
-            if source_file_path != result_file_path:
-                os.remove(result_file_path)
-        except Exception as error:
-            app.logger.error('Error removing or closing downloaded file handle')
-            app.logger.error(error)
-        return response
-
     return json_response(final_array)
 
 
+def recognize_upload(audio_data, file_extension):
+    audio = utils.decode_audio(app.logger, audio_data, file_extension)
+    if audio is None:
+        return None
+    return utils.recognize_audio(app.logger, audio)
+
+
+def encode_cursor(sort_key):
+    """
+    Opaque token for the page after the row with this sort key
+    """
+    value, song_id = sort_key
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, song_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :return: sort key to continue after, None when there is no cursor
+    :raise ValueError: malformed cursor
+    """
+    if not cursor:
+        return None
+    sort_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    if not isinstance(sort_key, list) or len(sort_key) != 2 or not isinstance(sort_key[1], int):
+        raise ValueError('bad cursor {}'.format(cursor))
+    return sort_key
+
+
+def paged_songs_response(rows, limit):
+    """
+    :param rows: (song id, sort key) pairs of one page, the next page cursor goes to the X-Next-Cursor header
+    """
+    result = songs_full_pack_info([{'id': row[0]} for row in rows])
+    response = json_response(project_songs(result))
+    if rows and len(rows) >= limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(rows[-1][1])
+    return response
+
+
 def song_full_pack_info(incoming_info):
-    song_basic_info = postgres.get_song_info_by_id(incoming_info['id'])
-    if not song_basic_info:
-        return {}
-    song_basic_info.update(incoming_info)
-    album_basic_info = postgres.get_album_info(song_basic_info['album_id'])
-    if not album_basic_info:
-        return song_basic_info
-
-    song_basic_info.update({
-        'song': {
-            'id': incoming_info['id'],
-            'title': song_basic_info['title'],
-            'singers': [
-                {
-                    'name': song_basic_info['author'],
-                }
-            ]
-        },
-        'album': {
-            'id': song_basic_info['album_id'],
-            'name': album_basic_info['title'],
-            'cover_url': 'https://zsong.ru/api/v2/cover?path=' + album_basic_info['cover_id'],
-            'year': album_basic_info['year']
-        }
+    return songs_full_pack_info([incoming_info])[0]
+
+
+def _song_key(song_id):
+    # get_found_songs_number hands out whole rows, e.g. (42,)
+    if isinstance(song_id, (list, tuple)):
+        song_id = song_id[0]
+    return int(song_id)
+
+
+def songs_full_pack_info(incoming_infos, user=None, likes=True):
+    """
+    Hydrate a list of {'id': song_id, ...} with song, album and like info
+    using a fixed number of queries whatever the length of the list
+    :param user: already resolved user, looked up with get_user() when None
+    :param likes: set to False to leave the per-user `like` flag out, see attach_likes()
+    """
+    result = _pack_songs(incoming_infos)[0]
+    if likes:
+        attach_likes(result, user=user)
+    return result
+
+
+def _pack_songs(incoming_infos):
+    """
+    :return: (packed songs, False when a query failed or a song could not be packed)
+    """
+    song_ids = list({_song_key(info['id']) for info in incoming_infos})
+    songs = postgres.get_songs_info_by_ids(song_ids)
+    # PsgClient answers tuple() instead of a dict when the query failed
+    complete = isinstance(songs, dict)
+    songs = songs or {}
+
+    merged_infos = []
+    for incoming_info in incoming_infos:
+        song_basic_info = songs.get(_song_key(incoming_info['id']))
+        if song_basic_info:
+            song_basic_info = dict(song_basic_info)
+            song_basic_info.update(incoming_info)
+        merged_infos.append((incoming_info, song_basic_info))
+
+    album_ids = list({
+        song_basic_info['album_id']
+        for _, song_basic_info in merged_infos
+        if song_basic_info and song_basic_info['album_id'] is not None
     })
+    albums = postgres.get_albums_info_by_ids(album_ids)
+    complete = complete and isinstance(albums, dict)
+    albums = albums or {}
+
+    result = []
+    for incoming_info, song_basic_info in merged_infos:
+        if not song_basic_info:
+            result.append({})
+            continue
+        album_basic_info = albums.get(song_basic_info['album_id'])
+        if not album_basic_info:
+            result.append(song_basic_info)
+            continue
+
+        song_basic_info.update({
+            'song': {
+                'id': incoming_info['id'],
+                'title': song_basic_info['title'],
+                'singers': [
+                    {
+                        'name': song_basic_info['author'],
+                    }
+                ]
+            },
+            'album': {
+                'id': song_basic_info['album_id'],
+                'name': album_basic_info['title'],
+                'cover_url': 'https://zsong.ru/api/v2/cover?path=' + album_basic_info['cover_id'],
+                'year': album_basic_info['year']
+            }
+        })
 
-    if song_basic_info.get('album') is None:
-        cover_num = (int(song_basic_info.get('id')) % 6) + 1
-        song_basic_info['album'] = {
-            'id': 0,
-            'name': '',
-            'cover_url': 'https://zsong.ru/static/no_cover_' + str(cover_num) + '.png'
-        }
+        if song_basic_info.get('album') is None:
+            cover_num = (int(song_basic_info.get('id')) % 6) + 1
+            song_basic_info['album'] = {
+                'id': 0,
+                'name': '',
+                'cover_url': 'https://zsong.ru/static/no_cover_' + str(cover_num) + '.png'
+            }
+
+        result.append(song_basic_info)
+
+    return result, complete and all(result)
 
-    has_like = postgres.get_has_like_song(get_user(), incoming_info['id'])
-    song_basic_info['like'] = has_like
-    
-    return song_basic_info
+
+def attach_likes(songs, user=None):
+    """
+    Set the `like` flag of every fully packed song for the current user with one query
+    """
+    packed = [song for song in songs if 'song' in song]
+    if not packed:
+        return songs
+    song_ids = list({_song_key(song['song']['id']) for song in packed})
+    liked_ids = postgres.get_liked_song_ids(user or get_user(), song_ids) or set()
+    for song in packed:
+        song['like'] = _song_key(song['song']['id']) in liked_ids
+    return songs
 
 
 @app.route('/api/v2/cover', methods=['GET'])
@@ -185,19 +428,40 @@ def cover():
                 'path',
             ]
         })
-    buffer = io.BytesIO()
-    cover_file = mongo.get_cover(path)
+    not_found = jsonify({
+        'code': '404',
+        'message': 'Found nothing',
+        'fields': [
+            'id',
+        ]
+    })
+    cover_id = mongo.normalize_id(path)
+    if cover_id is None:
+        return not_found
+
+    cover_headers = {
+        'Cache-Control': 'public, max-age={}, immutable'.format(COVER_MAX_AGE),
+    }
+    # covers are addressed by GridFS ObjectId and never change, the id is a strong ETag;
+    # `If-None-Match: *` only matches a cover that exists
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        not_modified = mongo.has_cover(cover_id)
+    else:
+        not_modified = if_none_match.contains(cover_id)
+    if not_modified:
+        response = Response(status=304, headers=cover_headers)
+        response.set_etag(cover_id)
+        return response
+
+    cover_file = mongo.open_cover(cover_id)
     if not cover_file:
-        return jsonify({
-            'code': '404',
-            'message': 'Found nothing',
-            'fields': [
-                'id',
-            ]
-        })
-    buffer.write(cover_file)
-    buffer.seek(0)
-    return send_file(buffer, attachment_filename='cover.jpg', mimetype='image/jpg')
+        return not_found
+    length, chunks = cover_file
+    cover_headers['Content-Length'] = str(length)
+    response = Response(chunks, mimetype='image/jpg', headers=cover_headers)
+    response.set_etag(cover_id)
+    return response
 
 
 @app.route('/api/v2/search', methods=['GET'])
@@ -240,17 +504,23 @@ def search():
             ]
         })
     updated_q = []
-    for word in query.split(' '):
-        closest_word = difflib.get_close_matches(word, translit_dict.keys(), n=1, cutoff=0.7)
-        if len(closest_word) > 0:
-            updated_q.append(translit_dict.get(closest_word[0]))
+    with metrics.timer('translit', 'translate'):
+        for word in query.split(' '):
+            translated = translit_index.translate(word)
+            if translated is not None:
+                updated_q.append(translated)
     if len(updated_q) != 0:
         query = ' '.join(updated_q)
 
     app.logger.info(query)
-    postgres.add_query_history(query)
-    found_ids = sphinx.find_songs(query, percent=search_percent)
-    if not found_ids:
+    history.add_query(query)
+    found_coordinates = search_cache.get(query, strict)
+    if found_coordinates is None:
+        found_coordinates, complete = find_coordinates(query, search_percent)
+        # results patched over a failed query would be served to everybody for SEARCH_CACHE_TTL
+        if found_coordinates and complete:
+            search_cache.set(query, strict, found_coordinates)
+    if found_coordinates is None:
         return jsonify({
             'code': '404',
             'message': 'Found nothing',
@@ -258,14 +528,33 @@ def search():
                 'id',
             ]
         })
-    found_coordinates = postgres.get_all_song_ids_and_timestamps(found_ids)
-    found_coordinates = postgres.get_relevant_rotation(found_ids, found_coordinates)
-    found_coordinates = list(map(song_full_pack_info, found_coordinates))
+    attach_likes(found_coordinates)
 
     for song in found_coordinates:
-        postgres.add_song_history(song.get('id'))
+        history.add_song(song.get('id'))
 
-    return json_response(found_coordinates)
+    return json_response(project_songs(found_coordinates))
+
+
+def find_coordinates(query, search_percent):
+    """
+    Search results shared by every user, without the per-user `like` flag
+    :return: (songs, None when Sphinx found nothing; False when a query failed on the way)
+    """
+    found_ids = sphinx.find_songs(query, percent=search_percent)
+    if not found_ids:
+        return None, False
+    found_coordinates = postgres.get_all_song_ids_and_timestamps(found_ids)
+    # tuple() when the query failed, None when none of the ids has a song
+    complete = not isinstance(found_coordinates, tuple)
+    found_coordinates = found_coordinates or []
+    rotated = postgres.get_relevant_rotation(found_ids, found_coordinates)
+    if isinstance(rotated, tuple):
+        complete = False
+    else:
+        found_coordinates = rotated
+    found_coordinates, packed = _pack_songs(found_coordinates)
+    return found_coordinates, complete and packed
 
 
 @app.route('/api/v2/search/popular', methods=['GET'])
@@ -284,7 +573,7 @@ def search_popular():
             ]
         })
 
-    result = postgres.get_popular_queries(limit)
+    result = popular_queries.top(limit)
     return json_response(result)
 
 
@@ -304,10 +593,10 @@ def song_popular():
             ]
         })
 
-    result = postgres.get_popular_songs(limit)
-    result = list(map(song_full_pack_info, result))
+    result = popular_songs.top(limit)
+    result = songs_full_pack_info(result)
 
-    return json_response(result)
+    return json_response(project_songs(result))
 
 
 @app.route('/api/v2/song/all', methods=['GET'])
@@ -327,11 +616,20 @@ def song_all():
                 'limit',
             ]
         })
-    offset = limit * (page - 1)
-    result = postgres.get_all_songs(offset, limit)
-    result = list(map(song_full_pack_info, result))
+    try:
+        after = decode_cursor(get_arg('cursor'))
+    except ValueError:
+        return jsonify({
+            'code': '400',
+            'message': 'wrong format',
+            'fields': [
+                'cursor',
+            ]
+        })
+    offset = limit * (page - 1) if after is None else 0
+    rows = postgres.get_all_songs_keyset(limit, offset=offset, after=after)
 
-    return json_response(result)
+    return paged_songs_response(rows, limit)
 
 
 @app.route('/api/v2/song/<song_id>/info', methods=['GET'])
@@ -370,8 +668,13 @@ def song_id_stream(song_id, from_ms, to_ms):
     info = postgres.get_song_info_by_id(song_id)
     if not info:
         return ''
-    res = cropper.get_song(info['mongo_id'], [[int(from_ms), int(to_ms)]])
-    return Response(res.text, mimetype='audio/mpeg')
+    try:
+        chunks = cropper.stream_song(info['mongo_id'], [[int(from_ms), int(to_ms)]])
+    except (ValueError, requests.RequestException) as e:
+        app.logger.error('Failed to get song {} from cropper'.format(song_id))
+        app.logger.error(e)
+        return ''
+    return Response(chunks, mimetype='audio/mpeg')
 
 
 @app.route('/api/v2/likes', methods=['GET'])
@@ -390,11 +693,20 @@ def get_my_likes_songs():
                 'limit',
             ]
         })
-    offset = limit * (page - 1)
-    result = postgres.get_user_likes_songs(get_user(), offset, limit)
-    result = list(map(song_full_pack_info, result))
+    try:
+        after = decode_cursor(get_arg('cursor'))
+    except ValueError:
+        return jsonify({
+            'code': '400',
+            'message': 'wrong format',
+            'fields': [
+                'cursor',
+            ]
+        })
+    offset = limit * (page - 1) if after is None else 0
+    rows = postgres.get_user_likes_songs_keyset(get_user(), limit, offset=offset, after=after)
 
-    return json_response(result)
+    return paged_songs_response(rows, limit)
 
 
 @app.route('/api/v2/song/<song_id>/like', methods=['POST'])
@@ -2,21 +2,81 @@ import logging
 import os
 import sys
 
+from external.cache import LRUCache
 from external.cropper_client import CropperDaemon
+from external.history_writer import HistoryWriter
+from external.metrics import Metrics
 from external.mongo_client import MongoC
 from external.pg_client import PsgClient
+from external.popularity import PopularityRanking
+from external.search_cache import SearchCache
 from external.sphinx_client import SphinxSearch
 
 logger = logging.getLogger('cherry-pick-api')
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
+
+def record_popularity(queries, song_ids):
+    # same filtering as PsgClient.get_popular_queries
+    popular_queries.record(query.lower() for query in queries if len(query) > 4)
+    popular_songs.record(song_ids)
+
+
 try:
-    sphinx = SphinxSearch(os.environ['SPHINX_HOST'], 9306, '', '')
+    # gunicorn workers share their metrics through METRICS_DIR, /metrics then reports all of them
+    metrics = Metrics(
+        directory=os.environ.get('METRICS_DIR') or None,
+        flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 1)),
+        logger=logger)
+    sphinx = SphinxSearch(
+        os.environ['SPHINX_HOST'], 9306, '', '',
+        min_conn=int(os.environ.get('SPHINX_POOL_MIN', 1)),
+        max_conn=int(os.environ.get('SPHINX_POOL_MAX', 10)),
+        pool_timeout=float(os.environ.get('SPHINX_POOL_TIMEOUT', 5)),
+        read_timeout=int(os.environ.get('SPHINX_READ_TIMEOUT', 5)),
+        logger=logger, metrics=metrics)
     postgres = PsgClient(
-        logger, os.environ['PSQL_HOST'], os.environ['PSQL_USER'], os.environ['PSQL_PASSWORD'], 'track_bar')
-    cropper = CropperDaemon(os.environ['CROPPER_HOST'], 8880)
-    mongo = MongoC(os.environ['MONGO_HOST'], 'test', 'fs')
+        logger, os.environ['PSQL_HOST'], os.environ['PSQL_USER'], os.environ['PSQL_PASSWORD'], 'track_bar',
+        min_conn=int(os.environ.get('PSQL_POOL_MIN', 1)),
+        max_conn=int(os.environ.get('PSQL_POOL_MAX', 10)),
+        pool_timeout=float(os.environ.get('PSQL_POOL_TIMEOUT', 5)),
+        use_snippet_store=os.environ.get('USE_SNIPPET_STORE', 'false').lower() in ('1', 'true', 'yes'),
+        metrics=metrics)
+    cropper = CropperDaemon(os.environ['CROPPER_HOST'], 8880, metrics=metrics)
+    history = HistoryWriter(
+        postgres, logger,
+        batch_size=int(os.environ.get('HISTORY_BATCH_SIZE', 100)),
+        flush_interval=float(os.environ.get('HISTORY_FLUSH_INTERVAL', 2)),
+        max_pending=int(os.environ.get('HISTORY_MAX_PENDING', 10000)))
+    popular_window = os.environ.get('POPULAR_WINDOW_DAYS')
+    popular_window = float(popular_window) * 24 * 60 * 60 if popular_window else None
+    popular_staleness = float(os.environ.get('POPULAR_MAX_STALENESS', 60))
+    popular_queries = PopularityRanking(
+        lambda limit: postgres.get_popular_queries(limit, window=popular_window),
+        'query', logger, max_staleness=popular_staleness)
+    popular_songs = PopularityRanking(
+        lambda limit: postgres.get_popular_songs(limit, window=popular_window),
+        'id', logger, max_staleness=popular_staleness)
+    history.subscribe(record_popularity)
+    search_cache = SearchCache(
+        logger,
+        ttl=int(os.environ.get('SEARCH_CACHE_TTL', 300)),
+        max_items=int(os.environ.get('SEARCH_CACHE_ITEMS', 1024)),
+        memcached=os.environ.get('MEMCACHED_HOST'))
+    # api_token -> user, short TTL bounds how long a revoked token keeps working in other workers
+    token_cache = LRUCache(
+        max_items=int(os.environ.get('TOKEN_CACHE_ITEMS', 10000)),
+        ttl=float(os.environ.get('TOKEN_CACHE_TTL', 60)))
+    mongo = MongoC(os.environ['MONGO_HOST'], 'test', 'fs', metrics=metrics)
+    metrics.register_stats('postgres_pool', postgres.pool_stats)
+    metrics.register_stats('sphinx_pool', sphinx.pool_stats)
+    metrics.register_stats('history', history.stats)
+    metrics.register_stats('search_cache', search_cache.stats)
+    metrics.register_stats('search_cache_lru', search_cache.local.stats)
+    metrics.register_stats('token_cache', token_cache.stats)
+    metrics.register_stats('cover_cache', mongo.covers.stats)
+    metrics.register_stats('clip_cache', cropper.clips.stats)
 except Exception as e:
     print(e)
     sys.exit(1)
@@ -1,15 +1,80 @@
 import json
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from .cache import LRUCache
 
 
 class CropperDaemon(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, connect_timeout=2.0, read_timeout=10.0, pool_size=10,
+                 cache_items=512, cache_bytes=64 * 1024 * 1024, max_cached_clip=1024 * 1024,
+                 chunk_size=16 * 1024, metrics=None):
         self.request_path = 'http://{}:{}/get_song/'.format(host, port)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_cached_clip = max_cached_clip
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        # (object id, intervals) -> mp3 bytes, the same snippet is replayed a lot
+        self.clips = LRUCache(max_items=cache_items, max_bytes=cache_bytes)
 
-    def get_song(self, object_id, intervals):
+    def _post(self, object_id, intervals, stream=False):
         request_json = {
             'objectId': object_id,
             'intervals': intervals
         }
-        return requests.post(self.request_path, data=json.dumps(request_json))
+        started = time.time()
+        try:
+            res = self.session.post(
+                self.request_path, data=json.dumps(request_json), timeout=self.timeout, stream=stream)
+        except requests.RequestException:
+            self._observe(started, error=True)
+            raise
+        # with stream=True this is the time to the response headers, the body is read by the caller
+        self._observe(started, error=not res.ok)
+        return res
+
+    def _observe(self, started, error=False):
+        if self.metrics is not None:
+            self.metrics.observe('cropper', 'get_song', time.time() - started, error)
+
+    def get_song(self, object_id, intervals):
+        return self._post(object_id, intervals)
+
+    def stream_song(self, object_id, intervals):
+        """
+        :return: iterator over the mp3 bytes of the cropped intervals
+        :raise requests.RequestException: cropper is down, slow or answered with an error
+        """
+        key = (object_id, tuple(tuple(interval) for interval in intervals))
+        cached = self.clips.get(key)
+        if cached is not None:
+            return iter([cached])
+
+        res = self._post(object_id, intervals, stream=True)
+        try:
+            res.raise_for_status()
+        except requests.RequestException:
+            res.close()
+            raise
+        return self._passthrough(key, res)
+
+    def _passthrough(self, key, res):
+        chunks = []
+        size = 0
+        try:
+            for chunk in res.iter_content(self.chunk_size):
+                if chunks is not None:
+                    size += len(chunk)
+                    if size <= self.max_cached_clip:
+                        chunks.append(chunk)
+                    else:
+                        chunks = None
+                yield chunk
+        finally:
+            res.close()
+        if chunks is not None:
+            self.clips.set(key, b''.join(chunks))
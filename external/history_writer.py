@@ -0,0 +1,122 @@
+import atexit
+import threading
+
+from .worker_thread import WorkerThread
+
+
+class HistoryWriter(object):
+    """
+    Write-behind buffer for query_history and song_history.
+
+    Events are queued in memory and written by a background thread with one
+    multi-row INSERT per table, whenever batch_size events are pending or
+    flush_interval seconds have passed. Whatever is left is flushed at exit.
+    When max_pending events are already waiting new ones are dropped and counted.
+    """
+
+    def __init__(self, postgres, logger, batch_size=100, flush_interval=2.0, max_pending=10000):
+        self.postgres = postgres
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._queries = []
+        self._songs = []
+        self._listeners = []
+        self._thread = WorkerThread(self._run, 'history-writer')
+        self._stopped = False
+
+        self._counters = {
+            'queued': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'failed': 0,
+            'flushes': 0,
+        }
+        atexit.register(self.stop)
+
+    def subscribe(self, listener):
+        """
+        :param listener: called as listener(queries, song_ids) with every batch that reached the database
+        """
+        self._listeners.append(listener)
+
+    def _add(self, bucket, value):
+        # bucket is an attribute name, flush() swaps the lists under the lock
+        if not self._stopped:
+            self._thread.ensure_started()
+        with self._lock:
+            if len(self._queries) + len(self._songs) >= self.max_pending:
+                self._counters['dropped'] += 1
+                return
+            getattr(self, bucket).append(value)
+            self._counters['queued'] += 1
+            pending = len(self._queries) + len(self._songs)
+        if self._stopped:
+            # late events during shutdown are written synchronously
+            self.flush()
+        elif pending >= self.batch_size:
+            self._wakeup.set()
+
+    def add_query(self, query):
+        self._add('_queries', query)
+
+    def add_song(self, song_id):
+        if not song_id:
+            return
+        self._add('_songs', song_id)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error('Failed to flush history')
+                self.logger.error(e)
+
+    def _write(self, bulk_insert, values):
+        if not values:
+            return []
+        written = bulk_insert(values)
+        with self._lock:
+            if written:
+                self._counters['flushed'] += len(values)
+            else:
+                self._counters['failed'] += len(values)
+        return values if written else []
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                queries, self._queries = self._queries, []
+                songs, self._songs = self._songs, []
+                if queries or songs:
+                    self._counters['flushes'] += 1
+            queries = self._write(self.postgres.add_query_history_bulk, queries)
+            songs = self._write(self.postgres.add_song_history_bulk, songs)
+            if queries or songs:
+                for listener in self._listeners:
+                    try:
+                        listener(queries, songs)
+                    except Exception as e:
+                        self.logger.error('History listener failed')
+                        self.logger.error(e)
+
+    def stop(self, timeout=5.0):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self.flush()
+        self.logger.info('History writer stopped: {}'.format(self.stats()))
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._counters)
+            result['pending'] = len(self._queries) + len(self._songs)
+            return result
@@ -0,0 +1,378 @@
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+from .worker_thread import WorkerThread
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CALLS_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram(object):
+    """
+    Prometheus style histogram: counts per upper bound (le), sum and count
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        if len(counts) != len(self.counts):
+            return
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestTimings(object):
+    """
+    Backend calls and time spent in them while serving one request
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # backend -> [calls, seconds]
+        self.backends = collections.OrderedDict()
+
+    def add(self, backend, duration):
+        with self._lock:
+            entry = self.backends.setdefault(backend, [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+
+    def calls(self, backend):
+        with self._lock:
+            return self.backends.get(backend, (0, 0.0))[0]
+
+    def server_timing(self, total=None, streamed=False):
+        """
+        :param streamed: the body is sent after the header, so total only covers the time to the first byte
+        :return: value of the Server-Timing header, durations in milliseconds
+        """
+        with self._lock:
+            parts = [
+                '{};dur={:.1f};desc="{} call{}"'.format(backend, seconds * 1000, calls, '' if calls == 1 else 's')
+                for backend, (calls, seconds) in self.backends.items()
+            ]
+        if total is not None:
+            parts.append('total;dur={:.1f}{}'.format(total * 1000, ';desc="before streaming"' if streamed else ''))
+        return ', '.join(parts)
+
+
+class TimedBody(object):
+    """
+    Response iterable that calls on_close(seconds since started) once the body was sent or dropped
+    """
+
+    def __init__(self, body, started, on_close):
+        self.body = body
+        self.started = started
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(time.time() - self.started)
+
+
+class Metrics(object):
+    """
+    Call counts and latencies of the backends, per process and per request.
+
+    Clients report every call with observe(). While a request is running in the
+    current thread (start_request/end_request) the call is also added to its
+    RequestTimings, which end_request folds into the per-endpoint histograms.
+    render() dumps everything in the Prometheus text format.
+
+    With a directory, every worker process writes a snapshot of its metrics to
+    <directory>/<pid>.json every flush_interval seconds, and render() adds up the
+    snapshots of all workers, so whichever worker answers a scrape reports the
+    totals. Snapshots of exited workers keep counting, so totals never go back;
+    empty the directory when the server starts.
+    """
+
+    HISTOGRAMS = (
+        ('backend_call_seconds', 'Latency of backend calls by client method.', ('backend', 'method')),
+        ('http_request_duration_seconds', 'Request latency by endpoint, including streamed bodies.',
+         ('endpoint',)),
+        ('backend_calls_per_request', 'Backend calls made by one request.', ('endpoint', 'backend')),
+    )
+    COUNTERS = (
+        ('backend_errors_total', 'Failed backend calls by client method.', ('backend', 'method')),
+        ('http_requests_total', 'Requests by endpoint and status.', ('endpoint', 'status')),
+    )
+
+    def __init__(self, prefix='cherrypick', latency_buckets=LATENCY_BUCKETS, calls_buckets=CALLS_BUCKETS,
+                 directory=None, flush_interval=1.0, logger=None):
+        """
+        :param directory: where worker processes share their snapshots, None to report this process only
+        """
+        self.prefix = prefix
+        self.buckets = {
+            'backend_call_seconds': latency_buckets,
+            'http_request_duration_seconds': latency_buckets,
+            'backend_calls_per_request': calls_buckets,
+        }
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._histograms = {name: {} for name, _, _ in self.HISTOGRAMS}
+        self._counters = {name: collections.Counter() for name, _, _ in self.COUNTERS}
+        # endpoint -> backends it ever called, requests that skip one of them count as 0 calls
+        self._endpoint_backends = collections.defaultdict(list)
+        self._stats = collections.OrderedDict()
+        self._writer = WorkerThread(self._run, 'metrics-writer') if directory is not None else None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self._write_snapshot)
+
+    def _histogram(self, name, key):
+        histograms = self._histograms[name]
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets[name])
+        return histogram
+
+    def _ensure_thread(self):
+        if self._writer is not None:
+            self._writer.ensure_started()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._write_snapshot()
+
+    def current(self):
+        return getattr(self._local, 'timings', None)
+
+    def start_request(self):
+        self._ensure_thread()
+        self._local.timings = RequestTimings()
+        return self._local.timings
+
+    def detach_request(self):
+        """
+        :return: RequestTimings of the current thread, which stops collecting, e.g. to finish a streamed response
+        """
+        timings = self.current()
+        self._local.timings = None
+        return timings
+
+    def end_request(self, endpoint, status, duration=None, timings=None):
+        """
+        :param duration: seconds spent on the request, None if it was not timed
+        :param timings: detached RequestTimings of the request, the current thread's by default
+        :return: RequestTimings of the finished request, None if start_request was not called
+        """
+        if timings is None:
+            timings = self.detach_request()
+        with self._lock:
+            self._counters['http_requests_total'][(endpoint, str(status))] += 1
+            if duration is not None:
+                self._histogram('http_request_duration_seconds', (endpoint,)).observe(duration)
+            if timings is not None:
+                backends = self._endpoint_backends[endpoint]
+                backends.extend(backend for backend in list(timings.backends) if backend not in backends)
+                for backend in backends:
+                    self._histogram('backend_calls_per_request', (endpoint, backend)).observe(timings.calls(backend))
+        return timings
+
+    def end_request_after(self, body, endpoint, status, started, timings):
+        """
+        Wrap a streamed response body so the request is recorded once the body was sent
+        """
+        return TimedBody(body, started, lambda duration: self.end_request(endpoint, status, duration, timings))
+
+    def observe(self, backend, method, duration, error=False):
+        self._ensure_thread()
+        with self._lock:
+            self._histogram('backend_call_seconds', (backend, method)).observe(duration)
+            if error:
+                self._counters['backend_errors_total'][(backend, method)] += 1
+        timings = self.current()
+        if timings is not None:
+            timings.add(backend, duration)
+
+    @contextlib.contextmanager
+    def timer(self, backend, method):
+        started = time.time()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(backend, method, time.time() - started, error)
+
+    def propagate(self, func):
+        """
+        Wrap func so calls made from an executor thread count towards the request that submitted them
+        """
+        timings = self.current()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = self.current()
+            self._local.timings = timings
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.timings = previous
+        return wrapper
+
+    def register_stats(self, name, stats):
+        """
+        Export the numeric values of stats() as gauges named <prefix>_<name>_<key>
+        """
+        self._stats[name] = stats
+
+    def snapshot(self):
+        """
+        :return: JSON serializable state of this process
+        """
+        stats = {}
+        for source, get_stats in list(self._stats.items()):
+            try:
+                stats[source] = {
+                    key: value for key, value in get_stats().items()
+                    if isinstance(value, (bool, int, float))
+                }
+            except Exception:
+                continue
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'histograms': {
+                    name: [[list(key), h.counts, h.sum, h.count] for key, h in histograms.items()]
+                    for name, histograms in self._histograms.items()
+                },
+                'counters': {
+                    name: [[list(key), count] for key, count in counters.items()]
+                    for name, counters in self._counters.items()
+                },
+                'stats': stats,
+            }
+
+    def _write_snapshot(self):
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        try:
+            with self._write_lock:
+                with open(path + '.tmp', 'w') as snapshot:
+                    json.dump(self.snapshot(), snapshot)
+                os.replace(path + '.tmp', path)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error('Failed to write metrics snapshot')
+                self.logger.error(e)
+
+    def _snapshots(self):
+        if self.directory is None:
+            return [self.snapshot()]
+        self._write_snapshot()
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as snapshot:
+                    snapshots.append(json.load(snapshot))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @staticmethod
+    def _labels(**labels):
+        return '{' + ','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for key, value in sorted(labels.items())) + '}'
+
+    def render(self):
+        snapshots = self._snapshots()
+        lines = []
+
+        for name, help_text, label_names in self.HISTOGRAMS:
+            merged = {}
+            for snapshot in snapshots:
+                for key, counts, total, count in snapshot['histograms'].get(name, ()):
+                    key = tuple(key)
+                    if key not in merged:
+                        merged[key] = Histogram(self.buckets[name])
+                    merged[key].merge(counts, total, count)
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} histogram'.format(name))
+            for key in sorted(merged):
+                histogram = merged[key]
+                labels = dict(zip(label_names, key))
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append('{}_bucket{} {}'.format(name, self._labels(le=le, **labels), count))
+                lines.append('{}_sum{} {!r}'.format(name, self._labels(**labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, self._labels(**labels), histogram.count))
+
+        for name, help_text, label_names in self.COUNTERS:
+            merged = collections.Counter()
+            for snapshot in snapshots:
+                for key, count in snapshot['counters'].get(name, ()):
+                    merged[tuple(key)] += count
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} counter'.format(name))
+            for key, count in sorted(merged.items()):
+                lines.append('{}{} {}'.format(name, self._labels(**dict(zip(label_names, key))), count))
+
+        # pools and caches are per process, report the live workers one by one
+        gauges = collections.OrderedDict()
+        for snapshot in sorted(snapshots, key=lambda snapshot: snapshot['pid']):
+            if self.directory is not None and not self._alive(snapshot['pid']):
+                continue
+            for source, values in sorted(snapshot['stats'].items()):
+                for key, value in sorted(values.items()):
+                    name = '{}_{}_{}'.format(self.prefix, source, key)
+                    gauges.setdefault(name, []).append((snapshot['pid'], value))
+        for name, values in gauges.items():
+            lines.append('# TYPE {} gauge'.format(name))
+            for pid, value in values:
+                lines.append('{}{} {!r}'.format(name, self._labels(pid=pid), float(value)))
+        return '\n'.join(lines) + '\n'
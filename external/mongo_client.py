@@ -1,18 +1,98 @@
+import time
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from gridfs import GridFS
 from pymongo import MongoClient
-from bson.objectid import ObjectId
+
+from .cache import LRUCache
 
 
 class MongoC(object):
-    def __init__(self, host, db_name, collection):
+    def __init__(self, host, db_name, collection, max_pool_size=50,
+                 cache_items=1024, cache_bytes=64 * 1024 * 1024, max_cached_cover=2 * 1024 * 1024,
+                 chunk_size=64 * 1024, metrics=None):
         self.connect_info = 'mongodb://{}:27017/'.format(host)
         self.db_name = db_name
         self.collection = collection
+        self.max_cached_cover = max_cached_cover
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        # one pooled client per process; connect=False defers sockets until first use (after fork)
+        self.client = MongoClient(self.connect_info, maxPoolSize=max_pool_size, connect=False)
+        self.fs = GridFS(self.client[self.db_name], self.collection)
+        # GridFS files are immutable, ObjectId -> bytes never goes stale
+        self.covers = LRUCache(max_items=cache_items, max_bytes=cache_bytes)
+
+    def _observe(self, method, started, error=False):
+        if self.metrics is not None:
+            self.metrics.observe('mongo', method, time.time() - started, error)
+
+    @staticmethod
+    def normalize_id(cover_id):
+        """
+        :return: canonical string form of the cover ObjectId, None if cover_id is not one
+        """
+        try:
+            return str(ObjectId(cover_id))
+        except (InvalidId, TypeError):
+            return None
+
+    def has_cover(self, cover_id):
+        cover_id = self.normalize_id(cover_id)
+        if cover_id is None:
+            return False
+        if cover_id in self.covers:
+            return True
+        started = time.time()
+        try:
+            exists = self.fs.exists(ObjectId(cover_id))
+        except Exception:
+            self._observe('has_cover', started, error=True)
+            raise
+        self._observe('has_cover', started)
+        return exists
+
+    def open_cover(self, cover_id):
+        """
+        :return: (length, iterator over byte chunks) or None if there is no such cover
+        """
+        cover_id = self.normalize_id(cover_id)
+        if cover_id is None:
+            return None
+        cached = self.covers.get(cover_id)
+        if cached is not None:
+            return len(cached), iter([cached])
+
+        started = time.time()
+        try:
+            cover = self.fs.find_one({'_id': ObjectId(cover_id)})
+        except Exception:
+            self._observe('find_cover', started, error=True)
+            raise
+        self._observe('find_cover', started)
+        if cover is None:
+            return None
+        return cover.length, self._stream(cover_id, cover)
+
+    def _stream(self, cover_id, cover):
+        keep = cover.length <= self.max_cached_cover
+        chunks = []
+        try:
+            while True:
+                chunk = cover.read(self.chunk_size)
+                if not chunk:
+                    break
+                if keep:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            cover.close()
+        if keep:
+            self.covers.set(cover_id, b''.join(chunks))
 
     def get_cover(self, cover_id):
-        client = MongoClient(self.connect_info)
-        fs = GridFS(client[self.db_name], self.collection)
-        cover = fs.find_one({'_id': ObjectId(cover_id) })
-        cover_file = cover.read() if cover is not None else None
-        client.close()
-        return cover_file
+        opened = self.open_cover(cover_id)
+        if opened is None:
+            return None
+        return b''.join(opened[1])
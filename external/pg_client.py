@@ -1,12 +1,17 @@
 import collections
+import time
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 
-from .utils import get_lengths, sub_splitter
+from .pool import ConnectionPool
+from .utils import get_lengths, pad_window, sub_splitter
 
 
 class PsgClient(object):
-    def __init__(self, logger, host, user, password, db_name):
+    def __init__(self, logger, host, user, password, db_name, min_conn=1, max_conn=10, pool_timeout=5.0,
+                 use_snippet_store=False, metrics=None):
         self._q_select_unique_songs = '''
         SELECT
             t.songid, s.album_id, s.file_id, array_agg(t.start_time_ms),
@@ -31,6 +36,19 @@ class PsgClient(object):
         WHERE s.id=%s;
         '''
 
+        self._q_select_albums = '''
+        SELECT id, title, cover_id, year
+        FROM album
+        WHERE id=ANY(%s);
+        '''
+
+        self._q_select_songs = '''
+        SELECT
+            s.id, s.author, s.title, s.lyrics, s.file_id, s.album_id, s.video_link, s.itunes_id
+        FROM songs AS s
+        WHERE s.id=ANY(%s);
+        '''
+
         self._q_get_ordered_lyrics_map = '''
         SELECT
             t.start_time_ms, t.phrase
@@ -47,11 +65,19 @@ class PsgClient(object):
         INSERT INTO song_history (songid) VALUES(%s);
         '''
 
+        self._q_add_to_query_history_bulk = '''
+        INSERT INTO query_history (query) VALUES %s;
+        '''
+
+        self._q_add_to_song_history_bulk = '''
+        INSERT INTO song_history (songid) VALUES %s;
+        '''
+
         self._q_popular_queries = '''
         SELECT
             qh.query, COUNT(*)
         FROM query_history AS qh
-        WHERE char_length(qh.query) > 4
+        WHERE char_length(qh.query) > 4 {}
         GROUP BY qh.query
         ORDER BY COUNT(*) DESC
         LIMIT {};
@@ -62,6 +88,7 @@ class PsgClient(object):
             sh.songid, COUNT(*)
         FROM song_history AS sh
         INNER JOIN songs AS s ON s.id = sh.songid
+        {}
         GROUP BY sh.songid
         ORDER BY COUNT(*) DESC
         LIMIT {};
@@ -74,19 +101,65 @@ class PsgClient(object):
         ORDER BY t.id;
         '''
 
+        self._q_closest_lyrics_batch = '''
+        SELECT t.id, t.songid, t.phrase
+        FROM transcription AS t
+        WHERE t.id=ANY(%s);
+        '''
+
+        self._q_select_snippets = '''
+        SELECT ts.transcription_id, ts.start_ms, ts.end_ms, ts.lines
+        FROM transcription_snippets AS ts
+        WHERE ts.transcription_id=ANY(%s);
+        '''
+
+        self._q_song_transcriptions = '''
+        SELECT t.id, t.start_time_ms, t.end_time_ms, t.phrase
+        FROM transcription AS t
+        WHERE t.songid=%s
+        ORDER BY t.id;
+        '''
+
+        self._q_upsert_snippets = '''
+        INSERT INTO transcription_snippets (transcription_id, song_id, start_ms, end_ms, lines)
+        VALUES %s
+        ON CONFLICT (transcription_id) DO UPDATE SET
+            song_id=EXCLUDED.song_id, start_ms=EXCLUDED.start_ms,
+            end_ms=EXCLUDED.end_ms, lines=EXCLUDED.lines;
+        '''
+
+        self._q_all_snippet_song_ids = '''
+        SELECT s.id FROM songs AS s ORDER BY s.id;
+        '''
+
+        self._q_missing_snippet_song_ids = '''
+        SELECT
+            DISTINCT t.songid
+        FROM transcription AS t
+        LEFT JOIN transcription_snippets AS ts ON ts.transcription_id = t.id
+        WHERE ts.transcription_id IS NULL
+        ORDER BY t.songid;
+        '''
+
+        # ordered by (SUBSTR(title, 2), id) to walk songs_sort_title_idx, see sql/indexes.sql
         self._q_all_songs = '''
         SELECT
-            DISTINCT s.id, SUBSTR(s.title, 2)
+            s.id, SUBSTR(s.title, 2)
         FROM songs AS s
-        ORDER BY SUBSTR(s.title, 2)
+        {}
+        ORDER BY SUBSTR(s.title, 2), s.id
         LIMIT {} OFFSET {};
         '''
 
-        self._q_sond_id_from_transcription = '''
+        self._q_all_songs_after = '''
+        WHERE (SUBSTR(s.title, 2), s.id) > (%s, %s)
+        '''
+
+        self._q_song_ids_from_transcriptions = '''
         SELECT
-            t.songid
+            t.id, t.songid
         FROM transcription AS t
-        WHERE t.id=%s;
+        WHERE t.id=ANY(%s);
         '''
 
         self._q_get_user_by_token_query = '''
@@ -97,16 +170,25 @@ class PsgClient(object):
         WHERE ut.token=%s;
         '''
 
+        # one row per (user, song), see sql/indexes.sql
         self._q_get_user_likes_songs_query = '''
         SELECT
-            sl.song_id, MAX(sl.created_at)
+            sl.song_id, sl.created_at
         FROM song_likes AS sl
         WHERE sl.user_id=%s
-        GROUP BY sl.song_id
-        ORDER BY MAX(sl.created_at) DESC
+        {}
+        ORDER BY sl.created_at DESC, sl.song_id DESC
         LIMIT {} OFFSET {};
         '''
 
+        self._q_get_user_likes_songs_after = '''
+        AND (sl.created_at, sl.song_id) < (%s, %s)
+        '''
+
+        self._q_touch_like_song_query = '''
+        UPDATE song_likes SET created_at=now() WHERE song_id=%s AND user_id=%s;
+        '''
+
         self._q_add_like_song_query = '''
         INSERT INTO song_likes (song_id, user_id) VALUES(%s, %s);
         '''
@@ -123,6 +205,14 @@ class PsgClient(object):
         AND sl.user_id=%s;
         '''
 
+        self._q_get_user_song_likes_query = '''
+        SELECT
+            DISTINCT sl.song_id
+        FROM song_likes AS sl
+        WHERE sl.song_id=ANY(%s)
+        AND sl.user_id=%s;
+        '''
+
         self._q_get_number_of_songs = '''
         SELECT
             DISTINCT t.songid
@@ -135,26 +225,73 @@ class PsgClient(object):
         self.db_host = host
         self.db_user = user
         self.db_password = password
-        self.conn = psycopg2.connect(
-            'postgres://{}:{}@{}:5432/{}'.format(user, password, host, db_name))
+        # read lyric snippets from transcription_snippets, filled by build_snippets.py
+        self.use_snippet_store = use_snippet_store
+        self.metrics = metrics
+        self.pool = ConnectionPool(
+            self._connect, minconn=min_conn, maxconn=max_conn, timeout=pool_timeout,
+            is_alive=self._is_alive, ping=self._ping, reset=self._reset)
+
+    def _connect(self):
+        return psycopg2.connect('postgres://{}:{}@{}:5432/{}'.format(
+            self.db_user, self.db_password, self.db_host, self.db_name))
+
+    @staticmethod
+    def _is_alive(conn):
+        return not conn.closed and \
+            conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+    @staticmethod
+    def _ping(conn):
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1;')
+        conn.rollback()
+
+    @staticmethod
+    def _reset(conn):
+        # do not keep read transactions open while the connection sits in the pool
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _observe(self, method, started, error=False):
+        if self.metrics is not None:
+            self.metrics.observe('postgres', method, time.time() - started, error)
 
     def reconnect(func):
         def deco(self, *args, **kwargs):
-            if self.conn.closed:
-                self.conn = psycopg2.connect('postgres://{}:{}@{}:5432/{}'.format(
-                    self.db_user, self.db_password, self.db_host, self.db_name))
-            cur = self.conn.cursor()
+            started = time.time()
+            try:
+                conn = self.pool.getconn()
+            except Exception as e:
+                self.logger.error('Failed to get psql connection')
+                self.logger.error(e)
+                self._observe(func.__name__, started, error=True)
+                return tuple()
+            broken = False
+            failed = False
+            cur = None
             try:
+                cur = conn.cursor()
                 return func(self, cur, *args, **kwargs)
             except Exception as e:
-                if not self.conn.closed:
-                    self.conn.rollback()
+                failed = True
+                broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+                if not conn.closed and not broken:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        broken = True
                 self.logger.error('Failed to execute psql query')
                 self.logger.error(e)
                 return tuple()
             finally:
-                if cur:
+                if cur is not None and not cur.closed:
                     cur.close()
+                self.pool.putconn(conn, close=broken or conn.closed)
+                self._observe(func.__name__, started, error=failed)
 
         return deco
 
@@ -172,16 +309,20 @@ class PsgClient(object):
 
     @reconnect
     def get_relevant_rotation(self, cur, relevant_ids_seq, arr_to_rearrange):
+        cur.execute(self._q_song_ids_from_transcriptions, (list(relevant_ids_seq),))
+        song_by_transcription = dict(cur.fetchall())
+        elements_by_song = collections.defaultdict(list)
+        for element in arr_to_rearrange:
+            elements_by_song[str(element['id'])].append(element)
+
         result_array = []
-        songs_seq = []
+        songs_seq = set()
         for id in relevant_ids_seq:
-            cur.execute(self._q_sond_id_from_transcription, (id,))
-            current_id = cur.fetchone()[0]
-            if current_id not in songs_seq:
-                songs_seq.append(current_id)
-                for element in arr_to_rearrange:
-                    if str(element['id']) == str(current_id):
-                        result_array.append(element)
+            current_id = song_by_transcription.get(id)
+            if current_id is None or current_id in songs_seq:
+                continue
+            songs_seq.add(current_id)
+            result_array.extend(elements_by_song.get(str(current_id), ()))
         return result_array if len(result_array) == len(arr_to_rearrange) else arr_to_rearrange
 
     @reconnect
@@ -189,56 +330,154 @@ class PsgClient(object):
         cur.execute(self._q_select_unique_songs, (ids,))
         ids_plus_chunks = cur.fetchall()
         if ids_plus_chunks:
-            result = []
+            selected = []
+            chunk_ids = set()
             for id in ids_plus_chunks:
-                song_id = id[0]
-                album_id = id[1]
-                mongo_path = id[2]
                 ts = [
                     list(i)
                     for i in zip(id[3], id[4], id[5])
                     ]
                 res_list = get_lengths(ts)
                 if res_list:
-                    lir_dicts_list = []
-                    for chunk in res_list:
-                        lir_dicts_list.append({
-                            'start': chunk[0],
-                            'end': chunk[1],
-                            'lyrics': [
-                                i.encode("cp1252").decode("utf-8", 'replace').replace('\ufffd', ' ')
-                                for i in self.get_closest_lyrics(chunk[2], song_id)
-                                ]
-                        })
-                    result.append({
-                        'id': song_id,
-                        'album_id': album_id,
-                        'mongo_path': mongo_path,
-                        'chunks': [i[:2] for i in res_list],
-                        'lyrics_chunks': lir_dicts_list
+                    selected.append((id, res_list))
+                    chunk_ids.update(chunk[2] for chunk in res_list)
+
+            snippets = {}
+            if self.use_snippet_store and chunk_ids:
+                cur.execute(self._q_select_snippets, (list(chunk_ids),))
+                snippets = {row[0]: (row[1], row[2], row[3]) for row in cur.fetchall() if row[3] is not None}
+
+            # rows not in the snippet store yet are split on the fly
+            window_ids = set()
+            for chunk_id in chunk_ids:
+                if chunk_id not in snippets:
+                    window_ids.update(self._lyrics_window(chunk_id))
+            phrases = {}
+            if window_ids:
+                cur.execute(self._q_closest_lyrics_batch, (list(window_ids),))
+                phrases = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+            result = []
+            for id, res_list in selected:
+                song_id = id[0]
+                album_id = id[1]
+                mongo_path = id[2]
+                chunks = []
+                lir_dicts_list = []
+                for chunk in res_list:
+                    if chunk[2] in snippets:
+                        start, end, lyrics = snippets[chunk[2]]
+                    else:
+                        start, end = chunk[0], chunk[1]
+                        lyrics = self._snippet_lines(chunk[2], song_id, phrases)
+                    chunks.append([start, end])
+                    lir_dicts_list.append({
+                        'start': start,
+                        'end': end,
+                        'lyrics': lyrics
                     })
+                result.append({
+                    'id': song_id,
+                    'album_id': album_id,
+                    'mongo_path': mongo_path,
+                    'chunks': chunks,
+                    'lyrics_chunks': lir_dicts_list
+                })
 
             return result
 
+    def _snippet_lines(self, transcription_id, song_id, phrases):
+        """
+        Display lines of one chunk
+        :param phrases: transcription id -> (song id, phrase), must hold the chunk neighbours
+        """
+        lyrics = [
+            phrases[i][1]
+            for i in sorted(self._lyrics_window(transcription_id))
+            if i in phrases and phrases[i][0] == song_id
+        ]
+        return [
+            i.encode("cp1252").decode("utf-8", 'replace').replace('\ufffd', ' ')
+            for i in self._split_closest_lyrics(lyrics)
+            ]
+
+    @reconnect
+    def get_snippet_song_ids(self, cur, missing_only=True):
+        """
+        :param missing_only: only songs with transcription rows that are not in the snippet store yet
+        """
+        cur.execute(self._q_missing_snippet_song_ids if missing_only else self._q_all_snippet_song_ids)
+        return [row[0] for row in cur.fetchall()]
+
+    @reconnect
+    def build_song_snippets(self, cur, song_id):
+        """
+        Precompute the padded window and display lines of every transcription row of a song
+        :return: number of rows written to transcription_snippets
+        """
+        cur.execute(self._q_song_transcriptions, (song_id,))
+        rows = cur.fetchall()
+        phrases = {row[0]: (song_id, row[3]) for row in rows}
+        values = []
+        for row in rows:
+            start, end = pad_window(row[1], row[2])
+            try:
+                lines = self._snippet_lines(row[0], song_id, phrases)
+            except UnicodeError:
+                # left for the request path, which fails on it the same way it always did
+                lines = None
+            values.append((row[0], song_id, start, end, lines))
+        if values:
+            psycopg2.extras.execute_values(cur, self._q_upsert_snippets, values, page_size=500)
+        cur.connection.commit()
+        return len(values)
+
+    @staticmethod
+    def _song_info(value):
+        return {
+            'author': value[0],
+            'title': value[1],
+            'lyrics': value[2],
+            'mongo_id': value[3],
+            'album_id': value[4],
+            'video_link': value[5],
+            'itunes_link': value[6]
+        }
+
+    @staticmethod
+    def _album_info(value):
+        return {
+            'title': value[0],
+            'cover_id': value[1],
+            'year': value[2]
+        }
+
     @reconnect
     def get_song_info_by_id(self, cur, id):
         cur.execute(self._q_select_song, (id,))
         value = cur.fetchone()
         if value and len(value) > 6:
-            return {
-                'author': value[0],
-                'title': value[1],
-                'lyrics': value[2],
-                'mongo_id': value[3],
-                'album_id': value[4],
-                'video_link': value[5],
-                'itunes_link': value[6]
-            }
+            return self._song_info(value)
+
+    @reconnect
+    def get_songs_info_by_ids(self, cur, ids):
+        """
+        Batch version of get_song_info_by_id
+        :return: dict song id -> song info, missing songs are left out
+        """
+        if not ids:
+            return {}
+        cur.execute(self._q_select_songs, (list(ids),))
+        return {
+            value[0]: self._song_info(value[1:])
+            for value in cur.fetchall()
+            if value and len(value) > 7
+        }
 
     @reconnect
     def add_query_history(self, cur, query):
         cur.execute(self._q_add_to_query_history, (query,))
-        self.conn.commit()
+        cur.connection.commit()
 
     @reconnect
     def add_song_history(self, cur, _id):
@@ -246,11 +485,35 @@ class PsgClient(object):
             return
         self.logger.info('Add song to history: `{}`'.format(_id))
         cur.execute(self._q_add_to_song_history, (_id,))
-        self.conn.commit()
+        cur.connection.commit()
+
+    @reconnect
+    def add_query_history_bulk(self, cur, queries):
+        psycopg2.extras.execute_values(
+            cur, self._q_add_to_query_history_bulk, [(query,) for query in queries], page_size=500)
+        cur.connection.commit()
+        return len(queries)
 
     @reconnect
-    def get_popular_queries(self, cur, limit=10):
-        cur.execute(self._q_popular_queries.format(limit))
+    def add_song_history_bulk(self, cur, ids):
+        psycopg2.extras.execute_values(
+            cur, self._q_add_to_song_history_bulk, [(_id,) for _id in ids], page_size=500)
+        cur.connection.commit()
+        return len(ids)
+
+    @staticmethod
+    def _window_filter(column, window):
+        if window is None:
+            return '', None
+        return "{} >= now() - %s * interval '1 second'".format(column), (window,)
+
+    @reconnect
+    def get_popular_queries(self, cur, limit=10, window=None):
+        """
+        :param window: only count queries of the last `window` seconds, None for all time
+        """
+        condition, params = self._window_filter('qh.created_at', window)
+        cur.execute(self._q_popular_queries.format('AND ' + condition if condition else '', limit), params)
         rows = cur.fetchall()
         if rows:
             result = []
@@ -263,8 +526,12 @@ class PsgClient(object):
             return []
 
     @reconnect
-    def get_popular_songs(self, cur, limit=10):
-        cur.execute(self._q_popular_song_ids.format(limit))
+    def get_popular_songs(self, cur, limit=10, window=None):
+        """
+        :param window: only count plays of the last `window` seconds, None for all time
+        """
+        condition, params = self._window_filter('sh.created_at', window)
+        cur.execute(self._q_popular_song_ids.format('WHERE ' + condition if condition else '', limit), params)
         rows = cur.fetchall()
         if rows:
             result = []
@@ -276,38 +543,60 @@ class PsgClient(object):
         else:
             return []
 
+    def get_all_songs(self, offset, limit):
+        return [{'id': row[0]} for row in self.get_all_songs_keyset(limit, offset=offset)]
+
     @reconnect
-    def get_all_songs(self, cur, offset, limit):
-        cur.execute(self._q_all_songs.format(limit, offset))
-        rows = cur.fetchall()
-        if rows:
-            result = []
-            for row in rows:
-                query = row[0]
-                result.append({'id': query})
-            return result
+    def get_all_songs_keyset(self, cur, limit, offset=0, after=None):
+        """
+        :param after: sort key (sort title, id) of the last song of the previous page
+        :return: list of (song id, sort key) ordered by sort title
+        """
+        if after is None:
+            cur.execute(self._q_all_songs.format('', limit, offset))
         else:
-            return []
+            cur.execute(self._q_all_songs.format(self._q_all_songs_after, limit, offset), tuple(after))
+        return [(row[0], (row[1], row[0])) for row in cur.fetchall()]
 
     @reconnect
     def get_album_info(self, cur, id):
         cur.execute(self._q_select_album, (id,))
         value = cur.fetchone()
         if value and len(value) > 2:
-            return {
-                'title': value[0],
-                'cover_id': value[1],
-                'year': value[2]
-            }
+            return self._album_info(value)
+
+    @reconnect
+    def get_albums_info_by_ids(self, cur, ids):
+        """
+        Batch version of get_album_info
+        :return: dict album id -> album info, missing albums are left out
+        """
+        if not ids:
+            return {}
+        cur.execute(self._q_select_albums, (list(ids),))
+        return {
+            value[0]: self._album_info(value[1:])
+            for value in cur.fetchall()
+            if value and len(value) > 3
+        }
+
+    @staticmethod
+    def _lyrics_window(lyr_id):
+        return [lyr_id, lyr_id - 1, lyr_id + 1]
 
     @reconnect
     def get_closest_lyrics(self, cur, lyr_id, song_id):
-        cur.execute(self._q_closest_lyrics, (song_id, [lyr_id, lyr_id - 1, lyr_id + 1]))
-        lyrics = cur.fetchall()
+        cur.execute(self._q_closest_lyrics, (song_id, self._lyrics_window(lyr_id)))
+        return self._split_closest_lyrics([i[0] for i in cur.fetchall()])
+
+    def _split_closest_lyrics(self, lyrics):
+        """
+        Turn the phrases around a chunk (ordered by transcription id) into at most three display lines
+        """
         messed_lyrics = [
-            i[0]
+            i
             for i in lyrics
-            if i[0] and i[0] != "" and "chorus" not in i[0].lower()
+            if i and i != "" and "chorus" not in i.lower()
         ]
         try:
             result_array = []
@@ -348,21 +637,25 @@ class PsgClient(object):
 
         return None
 
+    def get_user_likes_songs(self, user, offset, limit):
+        return [{'id': row[0]} for row in self.get_user_likes_songs_keyset(user, limit, offset=offset)]
+
     @reconnect
-    def get_user_likes_songs(self, cur, user, offset, limit):
+    def get_user_likes_songs_keyset(self, cur, user, limit, offset=0, after=None):
+        """
+        :param after: sort key (liked at, id) of the last song of the previous page
+        :return: list of (song id, sort key), latest likes first
+        """
         if user is None or user.get('id') is None:
             return []
 
-        cur.execute(self._q_get_user_likes_songs_query.format(limit, offset), (user.get('id'),))
-        rows = cur.fetchall()
-        if rows:
-            result = []
-            for row in rows:
-                query = row[0]
-                result.append({'id': query})
-            return result
+        if after is None:
+            cur.execute(self._q_get_user_likes_songs_query.format('', limit, offset), (user.get('id'),))
         else:
-            return []
+            cur.execute(
+                self._q_get_user_likes_songs_query.format(self._q_get_user_likes_songs_after, limit, offset),
+                (user.get('id'),) + tuple(after))
+        return [(row[0], (row[1], row[0])) for row in cur.fetchall()]
 
     @reconnect
     def add_like_song(self, cur, user, song_id):
@@ -370,8 +663,11 @@ class PsgClient(object):
             return False
 
         try:
-            cur.execute(self._q_add_like_song_query, (song_id, user.get('id')))
-            self.conn.commit()
+            # liking again moves the song to the top of /likes instead of adding a second row
+            cur.execute(self._q_touch_like_song_query, (song_id, user.get('id')))
+            if cur.rowcount == 0:
+                cur.execute(self._q_add_like_song_query, (song_id, user.get('id')))
+            cur.connection.commit()
             return True
         except:
             return False
@@ -383,7 +679,7 @@ class PsgClient(object):
 
         try:
             cur.execute(self._q_remove_like_song_query, (song_id, user.get('id')))
-            self.conn.commit()
+            cur.connection.commit()
             return True
         except:
             return False
@@ -398,6 +694,18 @@ class PsgClient(object):
 
         return row is not None
 
+    @reconnect
+    def get_liked_song_ids(self, cur, user, song_ids):
+        """
+        Batch version of get_has_like_song
+        :return: set of ids from song_ids liked by user
+        """
+        if user is None or user.get('id') is None or not song_ids:
+            return set()
+
+        cur.execute(self._q_get_user_song_likes_query, (list(song_ids), user.get('id')))
+        return {row[0] for row in cur.fetchall()}
+
     @reconnect
     def get_found_songs_number(self, cur, trascription_ids):
         cur.execute(self._q_get_number_of_songs, (trascription_ids,))
@@ -0,0 +1,149 @@
+import collections
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Bounded, thread safe pool of DB-API like connections.
+
+    :param connect: callable creating a new connection
+    :param minconn: connections opened up front and kept idle
+    :param maxconn: hard limit of open connections, callers wait for a free one
+    :param timeout: seconds to wait for a free connection before PoolTimeout
+    :param is_alive: cheap local check run on every checkout
+    :param ping: round trip check run on checkout when the connection was idle for more than ping_interval
+    :param reset: run on return to leave the connection clean, e.g. roll back an open transaction
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=5.0,
+                 is_alive=None, ping=None, ping_interval=30.0, reset=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('bad pool size min={} max={}'.format(minconn, maxconn))
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._is_alive = is_alive
+        self._ping = ping
+        self.ping_interval = ping_interval
+        self._reset = reset
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._size = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.time()))
+            self._size += 1
+
+    def _healthy(self, conn, idle_since):
+        try:
+            if self._is_alive is not None and not self._is_alive(conn):
+                return False
+            if self._ping is not None and time.time() - idle_since > self.ping_interval:
+                self._ping(conn)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        started = time.time()
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    waited = True
+                    remaining = self.timeout - (time.time() - started)
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout('no free connection after {}s'.format(self.timeout))
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn, idle_since = None, None
+                    # reserve the slot before connecting outside of the lock
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._healthy(conn, idle_since):
+                self._close(conn)
+                self._release_slot(discarded=True)
+                continue
+
+            with self._cond:
+                self._checkouts += 1
+                if waited:
+                    wait_time = time.time() - started
+                    self._waits += 1
+                    self._wait_time += wait_time
+                    self._max_wait_time = max(self._max_wait_time, wait_time)
+            return conn
+
+    def _release_slot(self, discarded=False):
+        with self._cond:
+            self._size -= 1
+            if discarded:
+                self._discarded += 1
+            self._cond.notify()
+
+    def putconn(self, conn, close=False):
+        if not close and self._reset is not None:
+            try:
+                self._reset(conn)
+            except Exception:
+                close = True
+        if close:
+            self._close(conn)
+            self._release_slot(discarded=True)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._close(conn)
+                self._size -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'minconn': self.minconn,
+                'maxconn': self.maxconn,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'wait_time_max': self._max_wait_time,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+            }
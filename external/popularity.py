@@ -0,0 +1,92 @@
+import collections
+import threading
+import time
+
+
+class PopularityRanking(object):
+    """
+    In-memory top-K kept next to a history table.
+
+    The top `capacity` rows are loaded with load(capacity), which returns
+    [{key: ..., 'count': ...}] like PsgClient.get_popular_*. Then record() bumps
+    counters as history gets written. The whole ranking is reloaded from the
+    database at most every max_staleness seconds, which also catches writes made
+    by other workers and expires rows that fell out of the time window.
+    """
+
+    def __init__(self, load, key, logger, capacity=1000, max_staleness=60.0, retry_interval=5.0):
+        """
+        :param retry_interval: seconds to keep serving the previous ranking after a failed reload
+        """
+        self._load = load
+        self.key = key
+        self.logger = logger
+        self.capacity = capacity
+        self.max_staleness = max_staleness
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._counts = None
+        self._loaded_at = 0.0
+        self._retry_at = 0.0
+
+    def _reload(self):
+        rows = self._load(self.capacity)
+        # PsgClient returns tuple() when the query failed and a list otherwise, even an empty one
+        if not isinstance(rows, list):
+            raise ValueError('popularity load failed, got {!r}'.format(rows))
+        counts = collections.Counter()
+        for row in rows:
+            counts[row[self.key]] += row['count']
+        with self._lock:
+            self._counts = counts
+            self._loaded_at = time.time()
+
+    def _stale(self):
+        now = time.time()
+        # after a failed reload nobody retries before retry_interval, not even without a ranking
+        if now < self._retry_at:
+            return False
+        return self._counts is None or now - self._loaded_at > self.max_staleness
+
+    def _ensure_fresh(self):
+        if not self._stale():
+            return
+        # one thread reloads, the others keep serving the previous ranking if there is one
+        if not self._reload_lock.acquire(self._counts is None):
+            return
+        try:
+            if self._stale():
+                self._reload()
+        except Exception as e:
+            # keep the previous ranking and _loaded_at, try again after retry_interval
+            self._retry_at = time.time() + self.retry_interval
+            self.logger.error('Failed to reload popularity ranking')
+            self.logger.error(e)
+        finally:
+            self._reload_lock.release()
+
+    def record(self, keys):
+        with self._lock:
+            if self._counts is None:
+                return
+            for key in keys:
+                self._counts[key] += 1
+
+    def top(self, limit):
+        """
+        :return: [{key: ..., 'count': ...}], limits above capacity go straight to load()
+        """
+        if limit > self.capacity:
+            return self._load(limit)
+        self._ensure_fresh()
+        with self._lock:
+            counts = self._counts.most_common(limit) if self._counts is not None else None
+        if counts is None:
+            # the first load failed just now or is waiting for retry_interval, answer like a failed query
+            return tuple()
+        return [
+            {self.key: key, 'count': count}
+            for key, count in counts
+        ]
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import threading
+
+from pymemcache.client.base import PooledClient
+
+from .cache import LRUCache
+
+
+class SearchCache(object):
+    """
+    Two tier cache of /api/v2/search results keyed by the normalized query and strict flag.
+
+    The local tier is an in-process LRU, the optional second tier is memcached
+    shared by all workers. Payloads are stored as JSON, so every hit gets its own
+    copy to decorate with per-user data.
+    """
+
+    def __init__(self, logger, ttl=300, max_items=1024, max_bytes=32 * 1024 * 1024,
+                 memcached=None, prefix='search:v1:'):
+        """
+        :param memcached: 'host:port' of the memcached tier, None to keep results in process only
+        """
+        self.logger = logger
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = LRUCache(max_items=max_items, max_bytes=max_bytes, ttl=ttl)
+        self.remote = None
+        if memcached:
+            host, _, port = memcached.partition(':')
+            self.remote = PooledClient(
+                (host, int(port or 11211)), connect_timeout=0.2, timeout=0.2, no_delay=True)
+
+        self._lock = threading.Lock()
+        self._counters = {
+            'local_hits': 0,
+            'remote_hits': 0,
+            'misses': 0,
+            'remote_errors': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def normalize(query):
+        # Sphinx MATCH ignores case and extra whitespace, so these variants share one entry
+        return ' '.join(query.lower().split())
+
+    def key(self, query, strict):
+        # memcached keys are limited to 250 ascii characters without spaces
+        raw = json.dumps([self.normalize(query), bool(strict)], ensure_ascii=True)
+        return self.prefix + hashlib.sha1(raw.encode('ascii')).hexdigest()
+
+    def get(self, query, strict):
+        key = self.key(query, strict)
+        serialized = self.local.get(key)
+        if serialized is not None:
+            self._count('local_hits')
+            return json.loads(serialized)
+
+        if self.remote is not None:
+            try:
+                serialized = self.remote.get(key)
+            except Exception as e:
+                self._count('remote_errors')
+                self.logger.error('Failed to read search cache from memcached')
+                self.logger.error(e)
+                serialized = None
+            if serialized is not None:
+                serialized = serialized.decode('utf-8')
+                self.local.set(key, serialized)
+                self._count('remote_hits')
+                return json.loads(serialized)
+
+        self._count('misses')
+        return None
+
+    def set(self, query, strict, payload):
+        key = self.key(query, strict)
+        serialized = json.dumps(payload)
+        self.local.set(key, serialized)
+        if self.remote is not None:
+            try:
+                self.remote.set(key, serialized.encode('utf-8'), expire=self.ttl, noreply=True)
+            except Exception as e:
+                self._count('remote_errors')
+                self.logger.error('Failed to write search cache to memcached')
+                self.logger.error(e)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._counters)
+        result['local'] = self.local.stats()
+        return result
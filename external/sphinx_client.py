@@ -1,43 +1,140 @@
+import time
+
 import pymysql.cursors
+from pymysql.constants import CLIENT
+
+from .pool import ConnectionPool
 
 
 class SphinxSearch(object):
-    def __init__(self, host, port, user, password):
+    def __init__(self, host, port, user, password, min_conn=1, max_conn=10, pool_timeout=5.0,
+                 connect_timeout=2, read_timeout=5, logger=None, metrics=None):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
-        self.connection = pymysql.connect(
-            host=self.host, port=self.port, user=self.user, passwd=self.password, charset='utf8', db='')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.logger = logger
+        self.metrics = metrics
+        self.pool = ConnectionPool(
+            self.connect, minconn=min_conn, maxconn=max_conn, timeout=pool_timeout,
+            is_alive=lambda connection: connection.open, ping=lambda connection: connection.ping(False))
+
+    def connect(self):
+        return pymysql.connect(
+            host=self.host, port=self.port, user=self.user, passwd=self.password, charset='utf8', db='',
+            connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+            write_timeout=self.read_timeout, client_flag=CLIENT.MULTI_STATEMENTS)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _observe(self, method, started, error=False):
+        if self.metrics is not None:
+            self.metrics.observe('sphinx', method, time.time() - started, error)
+
+    def _log_error(self, message, error):
+        if self.logger is not None:
+            self.logger.error(message)
+            self.logger.error(error)
 
     def reconnect(func):
+        """
+        Run func with a pooled connection, retry once on a fresh connection if it broke
+        before answering. Returns None when the query could not be run.
+        """
         def deco(self, *args, **kwargs):
-            if not self.connection.open:
-                self.connection = pymysql.connect(
-                    host=self.host, port=self.port, user=self.user, passwd=self.password, charset='utf8', db='')
-            return func(self, *args, **kwargs)
+            started = time.time()
+            result = call(self, *args, **kwargs)
+            self._observe(func.__name__.lstrip('_'), started, error=result is not True)
+            return result
+
+        def call(self, *args, **kwargs):
+            for _ in range(2):
+                try:
+                    connection = self.pool.getconn()
+                except Exception as e:
+                    self._log_error('Failed to get sphinx connection', e)
+                    return None
+                broken = False
+                try:
+                    result = func(self, connection, *args, **kwargs)
+                    # False: a statement failed and left its batch half read, do not reuse the connection
+                    broken = result is False
+                    return result
+                except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                    broken = True
+                    self._log_error('Lost sphinx connection', e)
+                    # a slow query would only be slow again, do not double the wait
+                    if 'timed out' in str(e):
+                        return None
+                except Exception as e:
+                    # a failed multi-statement leaves unread results behind, do not reuse it
+                    broken = True
+                    self._log_error('Failed to execute sphinx query', e)
+                    return None
+                finally:
+                    self.pool.putconn(connection, close=broken or not connection.open)
+            return None
         return deco
 
-    def connect(self):
-        self.connection = pymysql.connect(
-            host=self.host, port=self.port, user=self.user, passwd=self.password, charset='utf8', db='')
+    @staticmethod
+    def _match_query(connection, key_word, percent):
+        # escaped by the driver exactly like a bound %s parameter
+        return 'select * from songs_search where match({});'.format(
+            connection.escape('"' + key_word + '"/{}'.format(percent)))
+
+    @staticmethod
+    def _song_ids(result):
+        return [
+            int(x[0])
+            for x in result
+            if x and len(x) > 0
+        ]
+
+    def find_songs(self, key_word, percent='0.7'):
+        return self.find_songs_batch([key_word], percent=percent)[0]
+
+    def find_songs_batch(self, key_words, percent='0.7'):
+        """
+        Run one MATCH per key word in a single multi-statement round trip.
+        When one statement fails, the results before it are kept and the key words
+        after it are run one at a time, so a bad phrase only empties its own result.
+        :return: list of transcription ids for every key word, in order
+        """
+        if not key_words:
+            return []
+        results = []
+        if self._find_songs_batch(results, key_words, percent) is False:
+            # the statement at len(results) failed, the ones after it never ran
+            results.append([])
+            for key_word in key_words[len(results):]:
+                single = []
+                outcome = self._find_songs_batch(single, [key_word], percent)
+                if outcome is None:
+                    break
+                results.append(single[0] if outcome else [])
+        results.extend([] for _ in range(len(key_words) - len(results)))
+        return results[:len(key_words)]
 
     @reconnect
-    def find_songs(self, key_word, percent='0.7', recurse_on_fail=True):
+    def _find_songs_batch(self, connection, results, key_words, percent):
+        """
+        Fill results with the ids of every key word in order
+        :return: True, or False when a statement failed and results hold only the ones before it
+        """
+        del results[:]
+        # no `with`: closing the cursor drains the remaining results, which a failed batch never sends
+        cursor = connection.cursor()
         try:
-            with self.connection.cursor() as cursor:
-                # supposed to be injection free
-                # http://initd.org/psycopg/docs/usage.html#the-problem-with-the-query-parameters
-                cursor.execute('select * from songs_search where match(%s);',
-                               ('"' + key_word + '"/{}'.format(percent),))
-                result = cursor.fetchall()
-            return [
-                int(x[0])
-                for x in result
-                if x and len(x) > 0
-            ]
-        except:
-            if recurse_on_fail:
-                return self.find_songs(key_word, recurse_on_fail=False)
-            else:
-                return []
+            cursor.execute(' '.join(self._match_query(connection, key_word, percent) for key_word in key_words))
+            while True:
+                results.append(self._song_ids(cursor.fetchall()))
+                if not cursor.nextset():
+                    break
+        except (pymysql.err.ProgrammingError, pymysql.err.InternalError, pymysql.err.DataError) as e:
+            self._log_error('Failed to execute sphinx query', e)
+            return False
+        cursor.close()
+        return True
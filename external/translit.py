@@ -0,0 +1,85 @@
+import collections
+import difflib
+import functools
+
+
+class TranslitIndex(object):
+    """
+    Fuzzy lookup over a transliteration dictionary.
+
+    Gives exactly the same answer as
+    difflib.get_close_matches(word, translit_dict.keys(), n=1, cutoff=cutoff)
+    but only runs SequenceMatcher over keys that can pass difflib's own
+    real_quick_ratio() and quick_ratio() bounds. Keys are bucketed by length and
+    by (length, character) so those bounds are computed from an inverted index
+    instead of per key.
+    """
+
+    def __init__(self, translit_dict, cutoff=0.7, cache_size=4096):
+        self.translit_dict = translit_dict
+        self.cutoff = cutoff
+        self._keys = list(translit_dict.keys())
+        self._lengths = collections.defaultdict(list)
+        self._postings = collections.defaultdict(list)
+        for key in self._keys:
+            self._lengths[len(key)].append(key)
+            for ch, count in collections.Counter(key).items():
+                self._postings[(len(key), ch)].append((key, count))
+        self.get_close_match = functools.lru_cache(maxsize=cache_size)(self._get_close_match)
+
+    def _length_range(self, length):
+        # real_quick_ratio() == 2 * min(la, lb) / (la + lb) must reach cutoff
+        return [
+            i
+            for i in self._lengths
+            if self._ratio(min(i, length), i + length) >= self.cutoff
+        ]
+
+    @staticmethod
+    def _ratio(matches, length):
+        # same arithmetic as difflib._calculate_ratio
+        if length:
+            return 2.0 * matches / length
+        return 1.0
+
+    def _candidates(self, word):
+        word_length = len(word)
+        word_counts = collections.Counter(word)
+        candidates = []
+        for length in self._length_range(word_length):
+            if word_length == 0 or length == 0:
+                # nothing to intersect, quick_ratio() is decided by lengths alone
+                candidates.extend(
+                    key
+                    for key in self._lengths[length]
+                    if self._ratio(0, length + word_length) >= self.cutoff
+                )
+                continue
+            # quick_ratio() == 2 * |multiset intersection| / (la + lb)
+            intersections = collections.defaultdict(int)
+            for ch, count in word_counts.items():
+                for key, key_count in self._postings.get((length, ch), ()):
+                    intersections[key] += min(count, key_count)
+            candidates.extend(
+                key
+                for key, matches in intersections.items()
+                if self._ratio(matches, length + word_length) >= self.cutoff
+            )
+        return candidates
+
+    def _get_close_match(self, word):
+        best = None
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        for key in self._candidates(word):
+            matcher.set_seq1(key)
+            score = matcher.ratio()
+            if score >= self.cutoff and (best is None or (score, key) > best):
+                best = (score, key)
+        return best[1] if best is not None else None
+
+    def translate(self, word):
+        closest_word = self.get_close_match(word)
+        if closest_word is None:
+            return None
+        return self.translit_dict.get(closest_word)
@@ -1,4 +1,7 @@
-from subprocess import Popen, TimeoutExpired
+import io
+import os
+import tempfile
+from subprocess import PIPE, Popen, TimeoutExpired
 
 import speech_recognition as recognition
 
@@ -39,11 +42,90 @@ def convert_to_wav(logger, source_file_path, result_file_path):
     return False
 
 
+MP4_EXTENSIONS = {'mp4', 'm4a', 'aac'}
+
+
+def decode_to_pcm(logger, data, sample_rate=16000, timeout=5):
+    """
+    Decode audio bytes of any ffmpeg type to mono 16 bit PCM, piping through ffmpeg stdin/stdout
+    :param logger:
+    :param data: encoded audio
+    :param sample_rate:
+    :param timeout: seconds before ffmpeg gets killed
+    :return: (recognition.AudioData or None, ffmpeg stderr or None if it did not finish)
+    """
+    process = None
+    try:
+        process = Popen(
+            ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+             '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1'],
+            stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        outs, errs = process.communicate(input=data, timeout=timeout)
+        if process.returncode == 0 and outs:
+            return recognition.AudioData(outs, sample_rate, 2), errs
+        logger.error('Failed to decode audio through ffmpeg pipe')
+        logger.error(errs)
+        return None, errs
+    except TimeoutExpired:
+        process.kill()
+        process.communicate()
+        logger.error('Timed out decoding audio through ffmpeg pipe')
+    except Exception as e:
+        logger.error(e)
+    return None, None
+
+
+def decode_audio(logger, data, file_extension, sample_rate=16000):
+    """
+    :param logger:
+    :param data: uploaded bytes
+    :param file_extension: wav and flac are read directly, everything else goes through ffmpeg
+    :return: recognition.AudioData or None
+    """
+    if file_extension in ('wav', 'flac'):
+        try:
+            return read_audio(io.BytesIO(data))
+        except Exception as e:
+            logger.error(e)
+            return None
+    audio, errs = decode_to_pcm(logger, data, sample_rate)
+    if audio is not None:
+        return audio
+    # mp4 family files with the moov atom at the end can not be read from a pipe, only those
+    # go through a temp file; corrupt uploads and timeouts are not worth a second ffmpeg run
+    if file_extension not in MP4_EXTENSIONS or not errs or b'moov atom not found' not in errs:
+        return None
+    source_file_path = tempfile.NamedTemporaryFile(delete=False, suffix='.' + file_extension).name
+    result_file_path = tempfile.NamedTemporaryFile(delete=False, suffix='.wav').name
+    try:
+        with open(source_file_path, 'wb') as source:
+            source.write(data)
+        if convert_to_wav(logger, source_file_path, result_file_path):
+            return read_audio(result_file_path)
+    except Exception as e:
+        logger.error(e)
+    finally:
+        for path in (source_file_path, result_file_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return None
+
+
+def read_audio(path_or_file):
+    r = recognition.Recognizer()
+    with recognition.AudioFile(path_or_file) as source:
+        return r.record(source)
+
+
 def retrieve_phrase(logger, path_to_file):
+    return recognize_audio(logger, read_audio(path_to_file))
+
+
+def recognize_audio(logger, audio):
     r = recognition.Recognizer()
     r.operation_timeout = 5
-    with recognition.AudioFile(path_to_file) as source:
-        audio = r.record(source)
     result_list = []
     try:
         g_res = r.recognize_google(audio, show_all=True)
@@ -94,11 +176,17 @@ def get_lengths(ts):
     res = []
     for one in ts:
         if one[1] - one[0] < 6000:
-            res.append([
-                one[0] - 4000 if one[0] > 4000 else 0,
-                one[1] + 4000,
-                one[2]])
+            res.append(list(pad_window(one[0], one[1])) + [one[2]])
         else:
             res.append(one)
 
     return res
+
+
+def pad_window(start, end):
+    """
+    Time window shown for one transcription row, short rows get 4s of context on both sides
+    """
+    if end - start < 6000:
+        return start - 4000 if start > 4000 else 0, end + 4000
+    return start, end
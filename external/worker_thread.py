@@ -0,0 +1,40 @@
+import os
+import threading
+
+
+class WorkerThread(object):
+    """
+    Daemon thread running target, started on first use in every process.
+
+    Threads do not survive a fork, so a thread started in the gunicorn master
+    (or in a worker before it was recycled) is not there in the next worker;
+    ensure_started() notices the pid change and starts a fresh one.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def running(self):
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def ensure_started(self):
+        if self.running():
+            return
+        with self._lock:
+            if self.running():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.target, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def join(self, timeout=None):
+        """
+        Wait for the thread of this process, if it started one
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
@@ -0,0 +1,21 @@
+-- Indexes, and the one row per like cleanup, backing keyset pagination of /api/v2/song/all and /api/v2/likes.
+-- Safe to run more than once.
+
+-- /song/all walks songs by (SUBSTR(title, 2), id)
+CREATE INDEX IF NOT EXISTS songs_sort_title_idx
+    ON songs ((SUBSTR(title, 2)), id);
+
+-- /likes pages one row per (user, song) by the latest like. Older duplicate rows
+-- are folded into the latest one; add_like_song updates created_at from now on.
+DELETE FROM song_likes AS a
+    USING song_likes AS b
+    WHERE a.user_id = b.user_id AND a.song_id = b.song_id
+      AND (a.created_at < b.created_at OR (a.created_at = b.created_at AND a.ctid < b.ctid));
+
+CREATE UNIQUE INDEX IF NOT EXISTS song_likes_user_song_uidx
+    ON song_likes (user_id, song_id);
+
+CREATE INDEX IF NOT EXISTS song_likes_user_created_song_idx
+    ON song_likes (user_id, created_at DESC, song_id DESC);
+
+DROP INDEX IF EXISTS song_likes_user_song_created_idx;
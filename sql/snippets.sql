@@ -0,0 +1,13 @@
+-- Precomputed lyric snippets for search results, filled by build_snippets.py.
+-- One row per transcription row: padded time window and display lines.
+
+CREATE TABLE IF NOT EXISTS transcription_snippets (
+    transcription_id integer PRIMARY KEY,
+    song_id integer NOT NULL,
+    start_ms integer NOT NULL,
+    end_ms integer NOT NULL,
+    lines text[]
+);
+
+CREATE INDEX IF NOT EXISTS transcription_snippets_song_id_idx
+    ON transcription_snippets (song_id);